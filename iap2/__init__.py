@@ -1,3 +1,3 @@
-__all__ = ["control_session_message", "mfi_auth_coprocessor", "link_layer"]
+__all__ = ["control_session_message", "mfi_auth_coprocessor", "link_layer", "checksum", "connection_manager", "sharding", "send_scheduler", "ea_sessions"]
 
 import iap2.tests
@@ -1,4 +1,5 @@
 import asyncio
+import logging
 
 from iap2.control_session_message.wifi import AccessoryWiFiConfigurationInformation, \
     RequestAccessoryWiFiConfigurationInformation, SecurityType
@@ -9,7 +10,9 @@ from iap2.control_session_message.identification import IdentificationRejected,
     StartIdentification, IdentificationInformation, PowerProvidingCapability, ExternalAccessoryProtocol, MatchAction, \
     BluetoothTransportComponent, VehicleInformationComponent, EngineType, VehicleStatusComponent, \
     WirelessCarPlayTransportComponent
-from iap2.control_session_message.eap import StartExternalAccessoryProtocolSession, StopExternalAccessoryProtocolSession
+from iap2.control_session_message.eap import StartExternalAccessoryProtocolSession, StopExternalAccessoryProtocolSession, \
+    StatusExternalAccessoryProtocolSession
+from iap2.ea_sessions import EASessionManager
 from iap2.control_session_message.vehicle_status import StartVehicleStatusUpdates, StopVehicleStatusUpdates, \
     VehicleStatusUpdate
 from iap2.mfi_auth_coprocessor import read_certificate, generate_challenge_response
@@ -20,7 +23,9 @@ from iap2.control_session_message.authentication import RequestAuthenticationCer
 
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
+    logging.basicConfig(level=logging.DEBUG)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     register_csm(RequestAuthenticationCertificate)
     register_csm(RequestAuthenticationChallengeResponse)
     register_csm(AuthenticationSucceeded)
@@ -73,7 +78,8 @@ if __name__ == '__main__':
                     fireware_version="1.0.1",
                     hardware_version="2.0",
                     messages_sent_by_accessory=messages_ids(VehicleStatusUpdate,
-                                                            AccessoryWiFiConfigurationInformation),
+                                                            AccessoryWiFiConfigurationInformation,
+                                                            StatusExternalAccessoryProtocolSession),
                     messages_received_from_accessory=messages_ids(StartExternalAccessoryProtocolSession,
                                                                   StopExternalAccessoryProtocolSession,
                                                                   StartVehicleStatusUpdates,
@@ -121,6 +127,12 @@ if __name__ == '__main__':
                 raise Exception("identification failed")
 
 
+    async def handle_ea_echo(stream):
+        async for chunk in stream:
+            stream.write(bytes(chunk))
+            await stream.drain()
+
+
     async def main():
 
         def on_connection(reader, writer):
@@ -129,16 +141,20 @@ if __name__ == '__main__':
             async def iap_handler():
                 cert = await loop.run_in_executor(None, lambda: read_certificate())
 
-                conn = IAP2Connection(writer, reader, loop, max_outgoing=4)
+                conn = IAP2Connection(writer, reader, loop, congestion_control=True,
+                                      hints=BluetoothTransport.link_hints)
                 conn.start()
                 stream = conn.control_session
                 await handle_auth(stream, cert)
                 await handle_identification(stream)
+                ea_sessions = EASessionManager(conn, {1: handle_ea_echo})
 
                 while True:
                     incoming = await read_csm(stream)
                     print(incoming)
-                    if isinstance(incoming, RequestAccessoryWiFiConfigurationInformation):
+                    if ea_sessions.handle_csm(incoming):
+                        pass
+                    elif isinstance(incoming, RequestAccessoryWiFiConfigurationInformation):
                         info = AccessoryWiFiConfigurationInformation(
                             ssid="teslamodelx",
                             passphrase="testtest12",
@@ -0,0 +1,90 @@
+__all__ = ["AckPolicy", "ImmediateAckPolicy", "DelayedAckPolicy", "SessionAckPolicy"]
+
+from typing import Dict
+
+
+class AckPolicy:
+    """Decides when in-sequence data gets acknowledged.
+
+    Every in-sequence data packet is passed to :meth:`on_data`. Returning
+    True sends a pure ACK right away. Otherwise the ACK is deferred until the
+    ACK timeout expires or until it is piggybacked on outgoing data,
+    whichever happens first.
+
+    ``saved_acks`` counts the pure ACK frames not sent compared to
+    acknowledging every packet on its own.
+    """
+
+    def __init__(self):
+        self.saved_acks = 0
+        self._deferred = 0
+
+    def on_data(self, conn, session_id: int, pending: int) -> bool:
+        """``pending`` is the number of in-sequence packets not acknowledged yet."""
+        if self._ack_now(conn, session_id, pending):
+            return True
+        self._deferred += 1
+        return False
+
+    def on_ack(self, timer: bool):
+        """Called after an ACK covering all deferred packets went out.
+
+        ``timer`` is True if a pure ACK was sent because the ACK timeout
+        expired, that frame is paid for by the deferred packets.
+        """
+        if self._deferred:
+            self.saved_acks += self._deferred - 1 if timer else self._deferred
+            self._deferred = 0
+
+    def _ack_now(self, conn, session_id: int, pending: int) -> bool:
+        raise NotImplementedError
+
+
+class ImmediateAckPolicy(AckPolicy):
+    def _ack_now(self, conn, session_id: int, pending: int) -> bool:
+        return True
+
+
+class DelayedAckPolicy(AckPolicy):
+    """Acknowledges once ``max_pending`` packets are outstanding.
+
+    Without ``max_pending`` the negotiated maximum cumulative ACK count is
+    used, capped by the outgoing window of the peer.
+    """
+
+    def __init__(self, max_pending: int = None):
+        super().__init__()
+        self.max_pending = max_pending
+
+    def _ack_now(self, conn, session_id: int, pending: int) -> bool:
+        max_pending = self.max_pending
+        if max_pending is None:
+            max_pending = min(conn.lsp.max_ack, conn.lsp.max_outgoing - conn._max_outgoing_delta)
+        return pending >= max(max_pending, 1)
+
+
+class SessionAckPolicy(AckPolicy):
+    """Delegates to a policy per link session."""
+
+    def __init__(self, policies: Dict[int, AckPolicy], default: AckPolicy):
+        self.policies = policies
+        self.default = default
+        self._deferred_by = []
+
+    @property
+    def saved_acks(self):
+        return self.default.saved_acks + sum(p.saved_acks for p in self.policies.values())
+
+    def on_data(self, conn, session_id: int, pending: int) -> bool:
+        policy = self.policies.get(session_id, self.default)
+        if policy.on_data(conn, session_id, pending):
+            return True
+        if policy not in self._deferred_by:
+            self._deferred_by.append(policy)
+        return False
+
+    def on_ack(self, timer: bool):
+        for policy in self._deferred_by:
+            policy.on_ack(timer)
+            timer = False
+        self._deferred_by.clear()
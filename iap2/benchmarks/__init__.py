@@ -0,0 +1 @@
+__all__ = ["checksum", "packet_memory", "sharding", "control_latency", "ea_throughput"]
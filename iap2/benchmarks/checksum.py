@@ -0,0 +1,55 @@
+import os
+import timeit
+from functools import reduce
+
+from iap2 import checksum
+from iap2.checksum import Checksum, gen_checksum, NUMPY_THRESHOLD
+
+FRAME_SIZES = [9, 64, 512, 4096, 16384, 65535]
+CHUNK_SIZE = 1024
+
+
+def legacy_checksum(packet):
+    return -reduce(lambda a, b: (a + b) & 0xff, packet) & 0xff
+
+
+def pure_python_checksum(packet):
+    return -sum(packet) & 0xff
+
+
+def numpy_checksum(packet):
+    # the numpy kernel of byte_sum, without the size threshold
+    return -int(checksum.numpy.frombuffer(packet, dtype=checksum.numpy.uint8).sum(dtype=checksum.numpy.uint64)) & 0xff
+
+
+def streaming_checksum(packet):
+    c = Checksum()
+    view = memoryview(packet)
+    for i in range(0, len(view), CHUNK_SIZE):
+        c.update(view[i:i + CHUNK_SIZE])
+    return c.digest()
+
+
+def main():
+    modes = [("reduce", legacy_checksum), ("sum", pure_python_checksum), ("streaming", streaming_checksum),
+             ("gen_checksum", gen_checksum)]
+    if checksum.numpy is not None:
+        modes.append(("numpy", numpy_checksum))
+        print(f"gen_checksum uses numpy from {NUMPY_THRESHOLD} bytes on")
+    else:
+        print("numpy not installed, skipping numpy mode, gen_checksum uses sum")
+
+    print(f"{'size':>8}" + "".join(f"{name:>14}" for name, _ in modes) + "   (us per frame)")
+    for size in FRAME_SIZES:
+        frame = os.urandom(size)
+        expected = legacy_checksum(frame)
+        row = f"{size:>8}"
+        for _name, fn in modes:
+            assert fn(frame) == expected
+            number = max(10, 2000000 // (size * 10))
+            row += f"{timeit.timeit(lambda: fn(frame), number=number) / number * 1e6:>14.2f}"
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
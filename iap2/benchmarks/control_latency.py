@@ -0,0 +1,98 @@
+"""Control session latency under a saturating EA load.
+
+Two sans-IO links are connected by a simulated wire with a fixed bandwidth
+and propagation delay. One side keeps the EA session backlogged and sends a
+short control message every CONTROL_INTERVAL seconds, the time until the
+peer receives it is recorded. FIFO queueing is compared with the
+SendScheduler.
+"""
+import heapq
+from collections import deque
+from itertools import count
+
+from iap2.link_layer import IAP2Link, IAP2Packet, STATE_NORMAL
+from iap2.send_scheduler import SendScheduler
+
+BANDWIDTH = 250000  # bytes per second
+DELAY = 0.005
+DURATION = 20.0
+CONTROL_INTERVAL = 0.1
+EA_BACKLOG = 64
+EA_PACKET_SIZE = 1024
+MAX_OUTGOING = 8
+# orders wire events arriving at the same time
+SEQUENCE = count()
+
+
+class Wire:
+    """One direction of the simulated link."""
+
+    def __init__(self, events, receiver):
+        self._events = events
+        self._receiver = receiver
+        self._free_at = 0.0
+
+    def send(self, now, data):
+        if not data:
+            return
+        self._free_at = max(now, self._free_at) + len(data) / BANDWIDTH
+        heapq.heappush(self._events, (self._free_at + DELAY, next(SEQUENCE), self._receiver, data))
+
+
+def run(send_scheduler):
+    sender = IAP2Link(max_outgoing=MAX_OUTGOING, send_scheduler=send_scheduler)
+    receiver = IAP2Link(max_outgoing=MAX_OUTGOING)
+    ea_payload = b'\x00\x01' + bytes(EA_PACKET_SIZE - 2)
+    events = []
+    wires = {sender: Wire(events, receiver), receiver: Wire(events, sender)}
+    sent_at = dict()
+    latencies = []
+    now = 0.0
+    next_control = 1.0
+    control_count = 0
+    sender.start(now)
+    receiver.start(now)
+
+    while now < DURATION:
+        for link, wire in wires.items():
+            wire.send(now, b''.join(link.data_to_send()))
+        for session_id, payload in receiver.received_payloads():
+            if session_id == IAP2Link.CONTROL_SESSION_ID:
+                latencies.append(now - sent_at.pop(payload))
+
+        deadlines = [d for d in (sender.next_deadline(), receiver.next_deadline(), next_control) if d is not None]
+        if events:
+            deadlines.append(events[0][0])
+        now = min(deadlines)
+        while events and events[0][0] <= now:
+            _when, _seq, link, data = heapq.heappop(events)
+            link.receive_data(data, now)
+        sender.handle_timers(now)
+        receiver.handle_timers(now)
+        if sender.state != STATE_NORMAL:
+            continue
+        if now >= next_control:
+            payload = b'control %d' % control_count
+            control_count += 1
+            sent_at[payload] = now
+            sender.send_packet(IAP2Packet(payload, session_id=IAP2Link.CONTROL_SESSION_ID), now)
+            next_control = now + CONTROL_INTERVAL
+        while len(sender._queued_packets) < EA_BACKLOG:
+            sender.send_packet(IAP2Packet(ea_payload, session_id=IAP2Link.EA_SESSION_ID), now)
+    return sorted(latencies)
+
+
+def main():
+    print(f"{BANDWIDTH / 1000:.0f} kB/s, {DELAY * 1000:.0f} ms delay, EA backlog {EA_BACKLOG} packets")
+    print(f"{'queue':>10}{'samples':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, send_scheduler in [("fifo", deque()),
+                                 ("priority", SendScheduler(priority_sessions=[IAP2Link.CONTROL_SESSION_ID],
+                                                            stream_sessions=[IAP2Link.EA_SESSION_ID]))]:
+        latencies = run(send_scheduler)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"{name:>10}{len(latencies):>10}{p50:>10.1f}{p99:>10.1f}{latencies[-1] * 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
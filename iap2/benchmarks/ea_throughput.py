@@ -0,0 +1,66 @@
+"""EA stream throughput between two connections over an in-memory pipe.
+
+The sender writes large buffers and drains, the receiver reads them back
+with ``readinto``, so neither side copies the payload outside of the link
+layer itself.
+"""
+import argparse
+import asyncio
+import time
+
+from iap2.link_layer import IAP2Connection, TRANSPORT_LINK_HINTS, STATE_NORMAL
+from iap2.transport.memory import memory_transport_pair
+
+STREAM_ID = 1
+WRITE_SIZE = 1024 * 1024
+
+
+async def run(hints, megabytes):
+    a, b = memory_transport_pair()
+    sender = IAP2Connection(*a, hints=hints)
+    receiver = IAP2Connection(*b, hints=hints)
+    sender.start()
+    receiver.start()
+    while sender.state != STATE_NORMAL or receiver.state != STATE_NORMAL:
+        await asyncio.sleep(0.001)
+    out_stream = sender.create_ea_stream(STREAM_ID)
+    in_stream = receiver.create_ea_stream(STREAM_ID)
+    total = megabytes * 1024 * 1024
+    chunk = bytes(WRITE_SIZE)
+
+    async def pump():
+        for _ in range(total // WRITE_SIZE):
+            out_stream.write(chunk)
+            await out_stream.drain()
+
+    async def sink():
+        buffer = bytearray(WRITE_SIZE)
+        received = 0
+        while received < total:
+            received += await in_stream.readinto(buffer)
+
+    start = time.perf_counter()
+    await asyncio.gather(pump(), sink())
+    elapsed = time.perf_counter() - start
+    sender.abort()
+    receiver.abort()
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EA stream throughput over an in-memory pipe")
+    parser.add_argument("--megabytes", type=int, default=100)
+    parser.add_argument("--hints", nargs="+", default=["usb_bulk", "usb_hid", "bluetooth"],
+                        choices=sorted(TRANSPORT_LINK_HINTS))
+    args = parser.parse_args()
+
+    print(f"{args.megabytes} MB in {WRITE_SIZE // 1024} kB writes")
+    print(f"{'hints':>10}{'max_len':>10}{'MB/s':>10}")
+    for name in args.hints:
+        hints = TRANSPORT_LINK_HINTS[name]
+        throughput = asyncio.run(run(hints, args.megabytes)) / 1e6
+        print(f"{name:>10}{hints.max_len:>10}{throughput:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import tracemalloc
+from dataclasses import dataclass
+
+from iap2.link_layer import IAP2Packet, LinkPacketHeader, LinkFrameDecoder, CONTROL_ACK
+from iap2.checksum import gen_checksum
+
+WINDOW = 127
+PAYLOAD = bytes(64)
+
+
+class DictPacket:
+    """Packet layout before the link layer used __slots__."""
+
+    def __init__(self, data, psn=None, session_id=0):
+        self.psn = psn
+        self.data = data
+        self.session_id = session_id
+
+
+@dataclass
+class DictHeader:
+    length: int
+    control: int
+    seq: int
+    ack: int
+    session_id: int
+
+
+def send_state(p, psn):
+    p.counter = 0
+    p.fast_retransmits = 0
+    p.fast_retransmit_time = 0
+    p.psn = psn
+    p.sent_at = 1.0
+    p.timeout = 5.0
+    p.checksum = 0
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del objects
+    return size
+
+
+def window_of(packet_class):
+    def build():
+        packets = []
+        for psn in range(WINDOW):
+            p = packet_class(PAYLOAD, session_id=11)
+            send_state(p, psn)
+            packets.append(p)
+        return packets
+
+    return build
+
+
+def headers_of(header_class):
+    def build():
+        return [header_class(74, CONTROL_ACK, psn, 0, 11) for psn in range(WINDOW)]
+
+    return build
+
+
+def decoded_headers(reuse_header):
+    header = LinkPacketHeader(10 + len(PAYLOAD), CONTROL_ACK, 0, 0, 11).pack()
+    frame = header + PAYLOAD + bytes([gen_checksum(PAYLOAD)])
+
+    def build():
+        decoder = LinkFrameDecoder(reuse_header=reuse_header)
+        decoder.feed(frame * WINDOW)
+        # keep the headers alive like a consumer holding on to them would
+        return [h for h, _ in decoder]
+
+    return build
+
+
+def main():
+    print(f"per-object overhead for a window of {WINDOW} packets, payload excluded")
+    rows = [
+        ("IAP2Packet, dict", measure(window_of(DictPacket))),
+        ("IAP2Packet, slots", measure(window_of(IAP2Packet))),
+        ("LinkPacketHeader, dict", measure(headers_of(DictHeader))),
+        ("LinkPacketHeader, slots", measure(headers_of(LinkPacketHeader))),
+        ("decoded headers", measure(decoded_headers(False))),
+        ("decoded headers, pooled", measure(decoded_headers(True))),
+    ]
+    for name, size in rows:
+        print(f"{name:>26}: {size:>7} B total, {size / WINDOW:>6.1f} B per packet")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from struct import Struct
+
+from iap2.link_layer import IAP2Connection, STATE_NORMAL
+from iap2.sharding import ShardSupervisor
+
+CHUNK = bytes(1024)
+COUNT_STRUCT = Struct(">I")
+DONE = b'done'
+
+
+async def sink(conn):
+    """Reads the announced number of chunks, then reports back."""
+    stream = conn.control_session
+    (chunks,) = COUNT_STRUCT.unpack(await stream.readexactly(COUNT_STRUCT.size))
+    for _ in range(chunks):
+        await stream.readexactly(len(CHUNK))
+    stream.write(DONE)
+    await stream.drain()
+
+
+async def _client(address, connections, chunks):
+    conns = []
+    for _ in range(connections):
+        reader, writer = await asyncio.open_connection(*address)
+        conn = IAP2Connection(writer, reader)
+        conn.start()
+        conns.append(conn)
+    while not all(conn.state == STATE_NORMAL for conn in conns):
+        await asyncio.sleep(0.01)
+
+    async def pump(conn):
+        stream = conn.control_session
+        stream.write(COUNT_STRUCT.pack(chunks))
+        for _ in range(chunks):
+            stream.write(CHUNK)
+            await stream.drain()
+        await stream.readexactly(len(DONE))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(pump(conn) for conn in conns))
+    elapsed = time.perf_counter() - start
+    for conn in conns:
+        conn.abort()
+    return elapsed
+
+
+def _client_main(address, connections, chunks):
+    return asyncio.run(_client(address, connections, chunks))
+
+
+async def run(workers, connections, megabytes):
+    supervisor = ShardSupervisor(workers=workers, on_connection=sink)
+    supervisor.start()
+    try:
+        await supervisor.serve()
+        chunks = megabytes * 1024 // connections
+        clients = workers
+        per_client = [connections // clients + (1 if i < connections % clients else 0) for i in range(clients)]
+        loop = asyncio.get_running_loop()
+        with multiprocessing.get_context("spawn").Pool(clients) as pool:
+            elapsed = await loop.run_in_executor(
+                None, pool.starmap, _client_main, [(supervisor.address, n, chunks) for n in per_client if n])
+        return chunks * len(CHUNK) * connections / max(elapsed)
+    finally:
+        await supervisor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback throughput of sharded connections")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--megabytes", type=int, default=16)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cpus, {args.connections} connections, {args.megabytes} MB, "
+          f"client processes = workers")
+    print(f"{'workers':>8}{'MB/s':>10}{'speedup':>10}")
+    baseline = None
+    for workers in args.workers:
+        throughput = asyncio.run(run(workers, args.connections, args.megabytes)) / 1e6
+        baseline = baseline or throughput
+        print(f"{workers:>8}{throughput:>10.2f}{throughput / baseline:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+__all__ = ["gen_checksum", "check_checksum", "Checksum"]
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# below this size the NumPy call overhead outweighs its faster summation
+NUMPY_THRESHOLD = 2048
+
+
+def byte_sum(data) -> int:
+    if numpy is not None and len(data) >= NUMPY_THRESHOLD:
+        return int(numpy.frombuffer(data, dtype=numpy.uint8).sum(dtype=numpy.uint64))
+    if isinstance(data, memoryview):
+        # iterating bytes is more than twice as fast, which outweighs the copy
+        data = data.tobytes()
+    return sum(data)
+
+
+def gen_checksum(packet) -> int:
+    return -byte_sum(packet) & 0xff
+
+
+def check_checksum(packet) -> bool:
+    return byte_sum(packet) & 0xff == 0
+
+
+class Checksum:
+    """Running checksum for packets which are assembled from several buffers.
+
+    ``Checksum().update(header).update(payload).digest()`` equals
+    ``gen_checksum(header + payload)`` without concatenating the buffers.
+    """
+    __slots__ = ("_sum",)
+
+    def __init__(self, data=None):
+        self._sum = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data) -> "Checksum":
+        self._sum = (self._sum + byte_sum(data)) & 0xff
+        return self
+
+    def digest(self) -> int:
+        return -self._sum & 0xff
+
+    def check(self) -> bool:
+        return self._sum == 0
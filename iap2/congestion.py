@@ -0,0 +1,30 @@
+__all__ = ["AIMDController"]
+
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease send window.
+
+    The window grows by about one packet per window of cleanly acknowledged
+    packets and is halved on loss, at most once per round trip. It never
+    exceeds the negotiated maximum number of outgoing packets.
+    """
+
+    def __init__(self, initial_window: int = 4, min_window: int = 1):
+        self.cwnd = float(initial_window)
+        self.min_window = min_window
+        self.losses = 0
+        self._recovery_until = None
+
+    def window(self, max_outgoing: int) -> int:
+        return max(min(int(self.cwnd), max_outgoing), self.min_window)
+
+    def on_ack(self, acked: int, max_outgoing: int):
+        self.cwnd = min(self.cwnd + acked / self.cwnd, max_outgoing)
+
+    def on_loss(self, now: float, rtt: float):
+        """``rtt`` is the current round-trip estimate in seconds."""
+        if self._recovery_until is not None and now < self._recovery_until:
+            return
+        self.losses += 1
+        self.cwnd = max(self.cwnd / 2, self.min_window)
+        self._recovery_until = now + rtt
@@ -0,0 +1,88 @@
+__all__ = ["ConnectionManager", "ConnectionStats"]
+
+import asyncio
+from collections import namedtuple
+from functools import partial
+
+from iap2.link_layer import IAP2Connection, STATE_NORMAL, STATE_DEAD
+
+ConnectionStats = namedtuple("ConnectionStats", "connections established closed errors in_flight queued "
+                                                "retransmissions")
+
+
+class ConnectionManager:
+    """Owns a group of IAP2Connections sharing one event loop.
+
+    Connections created by :meth:`connect` are started right away and dropped
+    from the manager once they shut down. Keyword arguments given to the
+    manager are used as defaults for every connection.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, **connection_kwargs):
+        self._loop = loop
+        self._connection_kwargs = connection_kwargs
+        self._connections = dict()
+        self.closed = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __iter__(self):
+        return iter(list(self._connections))
+
+    def connect(self, output, input, **kwargs) -> IAP2Connection:
+        kwargs = {**self._connection_kwargs, **kwargs}
+        on_error = kwargs.pop("on_error", None)
+        on_close = kwargs.pop("on_close", None)
+        conn = IAP2Connection(output, input, self._loop,
+                              on_error=partial(self._on_error, on_error),
+                              **kwargs)
+        conn.on_close = partial(self._on_close, on_close, conn)
+        self._connections[conn] = None
+        conn.start()
+        return conn
+
+    def stats(self) -> ConnectionStats:
+        """Aggregates the state of all connections still open."""
+        established = in_flight = queued = retransmissions = 0
+        for conn in self._connections:
+            if conn.state == STATE_NORMAL:
+                established += 1
+            in_flight += len(conn._unack_packets)
+            queued += len(conn._queued_packets)
+            retransmissions += conn.retransmissions
+        return ConnectionStats(connections=len(self._connections),
+                               established=established,
+                               closed=self.closed,
+                               errors=self.errors,
+                               in_flight=in_flight,
+                               queued=queued,
+                               retransmissions=retransmissions)
+
+    async def shutdown(self, timeout: float = 1.0):
+        """Closes all connections, aborting the ones not done after ``timeout`` seconds."""
+        connections = list(self._connections)
+        for conn in connections:
+            conn.close()
+        waiters = [asyncio.ensure_future(conn.wait_closed()) for conn in connections]
+        if waiters:
+            await asyncio.wait(waiters, timeout=timeout)
+        for conn in connections:
+            if conn.state != STATE_DEAD:
+                conn.abort()
+        for waiter in waiters:
+            waiter.cancel()
+        self._connections.clear()
+
+    def _on_error(self, on_error, error):
+        self.errors += 1
+        if on_error:
+            on_error(error)
+
+    def _on_close(self, on_close, conn):
+        if conn in self._connections:
+            del self._connections[conn]
+            self.closed += 1
+        if on_close:
+            on_close()
@@ -20,6 +20,18 @@ async def read_csm(reader):
     if start != CSM_START:
         return
     payload = await reader.readexactly(length - 6)
+    return _deserialize_csm(msg_id, payload)
+
+
+def parse_csm(data):
+    """Parses a message received as a whole, e.g. a control session payload in packet mode."""
+    start, length, msg_id = CSM_STRUCT.unpack_from(data)
+    if start != CSM_START or length > len(data):
+        return
+    return _deserialize_csm(msg_id, bytes(data[6:length]))
+
+
+def _deserialize_csm(msg_id, payload):
     message_type = _MESSAGE_TYPES.get(msg_id)
     if message_type:
         message_instance = message_type.__new__(message_type)
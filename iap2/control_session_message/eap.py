@@ -1,15 +1,18 @@
+from dataclasses import dataclass
 from enum import IntEnum
 
 from iap2.control_session_message import csm, Uint16, Uint8
 
 
 @csm(0xEA00)
+@dataclass
 class StartExternalAccessoryProtocolSession:
     protocol_id: Uint8
     session_id: Uint16
 
 
 @csm(0xEA01)
+@dataclass
 class StopExternalAccessoryProtocolSession:
     session_id: Uint16
 
@@ -20,6 +23,7 @@ class SessionStatus(IntEnum):
 
 
 @csm(0xEA03)
+@dataclass
 class StatusExternalAccessoryProtocolSession:
     session_id: Uint16
     status: SessionStatus
@@ -0,0 +1,110 @@
+__all__ = ["DeadlineScheduler"]
+
+import asyncio
+from heapq import heappush, heappop, heapify
+
+# stale heap entries tolerated before the heap gets rebuilt
+COMPACT_SLACK = 64
+
+
+class DeadlineScheduler:
+    """Multiplexes the deadlines of one connection onto a single loop timer.
+
+    Every deadline is identified by a key. Rescheduling or cancelling a key
+    only updates the bookkeeping, the outdated heap entry is skipped once it
+    comes due. The loop timer is only re-created when a deadline earlier than
+    the armed one is scheduled.
+
+    Without a loop no timer is armed, due deadlines are then run by calling
+    :meth:`run_due` with the current time.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self._loop = loop
+        self._heap = []
+        self._pending = dict()
+        self._seq = 0
+        self._timer = None
+        self._timer_when = None
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def __len__(self):
+        return len(self._pending)
+
+    def deadline(self, key):
+        entry = self._pending.get(key)
+        return entry[0] if entry else None
+
+    def schedule(self, key, when, callback, *args):
+        self._seq += 1
+        self._pending[key] = (when, self._seq, callback, args)
+        heappush(self._heap, (when, self._seq, key))
+        if len(self._heap) > 2 * len(self._pending) + COMPACT_SLACK:
+            self._compact()
+        if self._timer_when is None or when < self._timer_when:
+            self._arm(when)
+
+    def cancel(self, key):
+        self._pending.pop(key, None)
+
+    def next_deadline(self):
+        heap = self._heap
+        pending = self._pending
+        while heap:
+            when, seq, key = heap[0]
+            entry = pending.get(key)
+            if entry is not None and entry[1] == seq:
+                return when
+            heappop(heap)
+        return None
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Starts arming timers on ``loop`` for the pending and future deadlines."""
+        self._loop = loop
+        when = self.next_deadline()
+        if when is not None:
+            self._arm(when)
+
+    def run_due(self, now):
+        """Runs the callbacks of all deadlines up to ``now``."""
+        heap = self._heap
+        pending = self._pending
+        while heap and heap[0][0] <= now:
+            _when, seq, key = heappop(heap)
+            entry = pending.get(key)
+            if entry is None or entry[1] != seq:
+                continue
+            del pending[key]
+            entry[2](*entry[3])
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = None
+        self._timer_when = None
+        self._heap.clear()
+        self._pending.clear()
+
+    def _compact(self):
+        self._heap = [(when, seq, key) for key, (when, seq, _callback, _args) in self._pending.items()]
+        heapify(self._heap)
+
+    def _arm(self, when):
+        if self._loop is None:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer_when = when
+        self._timer = self._loop.call_at(when, self._run)
+
+    def _run(self):
+        # the loop may fire a timer up to its clock resolution early
+        now = max(self._loop.time(), self._timer_when)
+        self._timer = None
+        self._timer_when = None
+        self.run_due(now)
+        when = self.next_deadline()
+        if when is not None and (self._timer_when is None or when < self._timer_when):
+            self._arm(when)
@@ -0,0 +1,118 @@
+__all__ = ["EASessionManager"]
+
+import asyncio
+import logging
+
+from iap2.control_session_message import register_csm, write_csm, Uint16
+from iap2.control_session_message.eap import StartExternalAccessoryProtocolSession, \
+    StopExternalAccessoryProtocolSession, StatusExternalAccessoryProtocolSession, SessionStatus
+from iap2.link_layer import IAP2Connection
+
+logger = logging.getLogger(__name__)
+
+# EA data kept for sessions whose start message was not handled yet
+PENDING_LIMIT = 64 * 1024
+
+
+class EASessionManager:
+    """Opens and closes the EA streams of a connection as the device asks for them.
+
+    Messages read from the control session are passed to :meth:`handle_csm`.
+    A started session gets a stream on the connection, and the handler
+    registered for its protocol is run with it as a task. The stream ends
+    when the device stops the session, so handlers should return once they
+    read the end of the stream. When a handler returns on its own, the
+    session is reported as closed to the device.
+
+    The device may send data right after starting a session, before the
+    start message is read from the control session. The connection keeps
+    such data, up to ``pending_limit`` bytes, for the stream created later.
+    """
+
+    def __init__(self, conn: IAP2Connection, handlers=None, pending_limit: int = PENDING_LIMIT):
+        self.conn = conn
+        conn.pending_ea_limit = max(conn.pending_ea_limit, pending_limit)
+        self._handlers = dict(handlers or {})
+        # session id -> (stream, task)
+        self._sessions = dict()
+        self._tasks = set()
+        register_csm(StartExternalAccessoryProtocolSession)
+        register_csm(StopExternalAccessoryProtocolSession)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def register_protocol(self, protocol_id: int, handler):
+        """Runs ``await handler(stream)`` for every session of ``protocol_id``."""
+        self._handlers[protocol_id] = handler
+
+    def handle_csm(self, message) -> bool:
+        """Handles the EA session messages, returns whether ``message`` was one."""
+        if isinstance(message, StartExternalAccessoryProtocolSession):
+            self._start(message.protocol_id, message.session_id)
+        elif isinstance(message, StopExternalAccessoryProtocolSession):
+            self._stop(message.session_id)
+        else:
+            return False
+        return True
+
+    async def close(self):
+        """Cancels all session handlers and closes their streams."""
+        for session_id in list(self._sessions):
+            self._stop(session_id)
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _start(self, protocol_id, session_id):
+        if session_id in self._sessions:
+            logger.warning("EA session %d started twice, replacing it", session_id)
+            self._stop(session_id)
+        handler = self._handlers.get(protocol_id)
+        if handler is None:
+            logger.warning("no handler for EA protocol %d, closing session %d", protocol_id, session_id)
+            self.conn.close_ea_stream(session_id)
+            self._spawn(self._send_close(session_id))
+            return
+        stream = self.conn.create_ea_stream(session_id)
+        task = self._spawn(self._run(session_id, stream, handler))
+        self._sessions[session_id] = (stream, task)
+
+    def _stop(self, session_id):
+        self._sessions.pop(session_id, None)
+        # also drops data kept for a session not started yet
+        self.conn.close_ea_stream(session_id)
+
+    def _spawn(self, coro):
+        task = self.conn._get_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, session_id, stream, handler):
+        try:
+            await handler(stream)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("handler of EA session %d failed", session_id)
+        session = self._sessions.get(session_id)
+        if session is None or session[0] is not stream:
+            # stopped by the device
+            return
+        self._stop(session_id)
+        await self._send_close(session_id)
+
+    async def _send_close(self, session_id):
+        control = self.conn.control_session
+        if control.closed:
+            return
+        try:
+            await write_csm(control, StatusExternalAccessoryProtocolSession(session_id=Uint16(session_id),
+                                                                            status=SessionStatus.CLOSE))
+        except IOError:
+            pass
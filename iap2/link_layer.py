@@ -1,22 +1,42 @@
-__all__ = ["IAP2Connection", "IAP2Stream"]
+__all__ = ["IAP2Link", "IAP2Connection", "IAP2Stream", "IAP2PacketQueue"]
 
 import asyncio
-from collections import namedtuple
+import logging
+import mmap
+import os
+import time
+from contextlib import suppress
+from collections import namedtuple, deque, Counter
 from dataclasses import dataclass
-from functools import reduce
 from struct import Struct
 from typing import ClassVar, List, Callable, Any
 
+from iap2.ack_policy import AckPolicy, SessionAckPolicy, ImmediateAckPolicy, DelayedAckPolicy
+from iap2.checksum import gen_checksum, check_checksum, Checksum
+from iap2.congestion import AIMDController
+from iap2.deadline_scheduler import DeadlineScheduler
+from iap2.psn_ring import PSNRing
+from iap2.rtt_estimator import RTTEstimator, MIN_RETRANSMISSION_TIMEOUT
+from iap2.send_scheduler import SendScheduler
+
 CONTROL_SYN = 0x80
 CONTROL_ACK = 0x40
 CONTROL_EAK = 0x20
 CONTROL_RST = 0x10
 
-loop = asyncio.get_event_loop()
+logger = logging.getLogger(__name__)
+
+LINK_PACKET_START = b'\xFF\x5A'
+LINK_PACKET_HEADER_LENGTH = 9
+READ_CHUNK_SIZE = 65536
+CHECKSUM_BYTES = [bytes([i]) for i in range(256)]
+# repeated pure ACKs for the same PSN which are taken as a loss signal
+DUPLICATE_ACK_THRESHOLD = 2
 
 
 @dataclass
 class LinkPacketHeader:
+    __slots__ = ("length", "control", "seq", "ack", "session_id")
     struct: ClassVar = Struct(">HHBBBB")
     start: ClassVar = 0xFF5A
     length: int
@@ -27,13 +47,26 @@ class LinkPacketHeader:
 
     @staticmethod
     def from_bytes(header_bytes):
-        if not check_checksum(header_bytes):
+        return LinkPacketHeader.from_buffer(header_bytes)
+
+    @staticmethod
+    def from_buffer(buffer, offset=0, into: "LinkPacketHeader" = None):
+        """Parses the header at ``offset``, refilling ``into`` instead of
+        allocating a new header if given."""
+        if not check_checksum(buffer[offset:offset + LINK_PACKET_HEADER_LENGTH]):
             return None
         (start, length, control, seq, ack,
-         session_id) = LinkPacketHeader.struct.unpack(header_bytes[:-1])
+         session_id) = LinkPacketHeader.struct.unpack_from(buffer, offset)
         if start != LinkPacketHeader.start:
             return None
-        return LinkPacketHeader(length, control, seq, ack, session_id)
+        if into is None:
+            return LinkPacketHeader(length, control, seq, ack, session_id)
+        into.length = length
+        into.control = control
+        into.seq = seq
+        into.ack = ack
+        into.session_id = session_id
+        return into
 
     def pack(self):
         header_bytes = LinkPacketHeader.struct.pack(LinkPacketHeader.start,
@@ -47,16 +80,78 @@ def signed_add(a, b):
     return (a + b) & 0xff
 
 
-def gen_checksum(packet):
-    return -reduce(signed_add, packet) & 0xff
+class LinkFrameDecoder:
+    """Incremental decoder which splits a byte stream into link packets.
 
+    Bytes are buffered with :meth:`feed`; iterating the decoder yields
+    ``(header, payload)`` for every complete packet already buffered and
+    discards line noise in between. Incomplete packets stay buffered until
+    the next call to :meth:`feed`.
 
-def check_checksum(packet):
-    return reduce(signed_add, packet) == 0
+    With ``reuse_header`` every packet is yielded with the same header
+    object, which is only valid until the iteration continues.
+    """
+
+    def __init__(self, reuse_header: bool = False):
+        self._buffer = bytearray()
+        self._header = LinkPacketHeader(0, 0, 0, 0, 0) if reuse_header else None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        self._buffer += data
+
+    def __iter__(self):
+        buffer = self._buffer
+        pos = 0
+        try:
+            while True:
+                pos = buffer.find(LINK_PACKET_START, pos)
+                if pos < 0:
+                    # a trailing 0xFF might be the first half of the next start word
+                    pos = len(buffer) - 1 if buffer.endswith(LINK_PACKET_START[:1]) else len(buffer)
+                    return
+                if len(buffer) - pos < LINK_PACKET_HEADER_LENGTH:
+                    return
+                payload = None
+                with memoryview(buffer) as view:
+                    header = LinkPacketHeader.from_buffer(view, pos, self._header)
+                    if not header or header.length < LINK_PACKET_HEADER_LENGTH:
+                        pos += 1
+                        continue
+                    end = pos + header.length
+                    if end > len(buffer):
+                        return
+                    if header.length > LINK_PACKET_HEADER_LENGTH:
+                        payload = bytes(view[pos + LINK_PACKET_HEADER_LENGTH:end - 1])
+                        if gen_checksum(payload) != buffer[end - 1]:
+                            payload = None
+                pos = end
+                if header.length > LINK_PACKET_HEADER_LENGTH and payload is None:
+                    continue
+                yield header, payload
+        finally:
+            del buffer[:pos]
 
 
 LSPSession = namedtuple('LSPSession', 'id type version')
 
+# Link parameters a transport prefers, timeouts are in milliseconds.
+# max_len is the longest packet the accessory wants to receive.
+LinkHints = namedtuple('LinkHints', 'max_len retransmission_timeout ack_timeout max_outgoing')
+
+# Starting points per carrier for transports which do not advertise their own
+# hints. USB bulk endpoints move large frames with sub-millisecond latency, HID
+# reports carry only a few dozen bytes per interrupt transfer and RFCOMM adds
+# tens of milliseconds of radio latency.
+TRANSPORT_LINK_HINTS = {
+    "default": LinkHints(max_len=65535, retransmission_timeout=4000, ack_timeout=500, max_outgoing=30),
+    "usb_bulk": LinkHints(max_len=65535, retransmission_timeout=500, ack_timeout=10, max_outgoing=30),
+    "usb_hid": LinkHints(max_len=4096, retransmission_timeout=1000, ack_timeout=25, max_outgoing=8),
+    "bluetooth": LinkHints(max_len=2048, retransmission_timeout=2000, ack_timeout=100, max_outgoing=16),
+}
+
 
 @dataclass
 class LinkSynchronizationPayload:
@@ -102,152 +197,622 @@ STATE_DEAD = 3
 
 IAP2_MARKER = b'\xFF\x55\x02\x00\xEE\x10'
 EA_SESSION_ID_STRUCT = Struct(">H")
+# default stream write buffer limits, as for asyncio transports
+DEFAULT_HIGH_WATER = 64 * 1024
 
 
 class IAP2Packet:
-    def __init__(self, data: bytes, psn: int = None, session_id: int = 0):
+    __slots__ = ("psn", "data", "prefix", "session_id", "checksum", "counter", "fast_retransmits",
+                 "fast_retransmit_time", "sent_at", "timeout")
+
+    def __init__(self, data: bytes, psn: int = None, session_id: int = 0, prefix: bytes = b''):
         self.psn = psn
         self.data = data
+        # sent in front of data, e.g. the EA stream id, so data can be a view of the caller's buffer
+        self.prefix = prefix
         self.session_id = session_id
+        # checksum of prefix and data, computed on the first transmission
+        self.checksum = None
+        # retransmission state, set once the packet is sent
+        self.counter = 0
+        self.fast_retransmits = 0
+        self.fast_retransmit_time = 0
+        self.sent_at = None
+        self.timeout = None
+
+
+def take_views(chunks: deque, n: int):
+    """Removes the first ``n`` bytes from a deque of memoryviews, returning them as a list of memoryviews."""
+    views = []
+    while n > 0:
+        chunk = chunks[0]
+        if len(chunk) <= n:
+            chunks.popleft()
+            views.append(chunk)
+            n -= len(chunk)
+        else:
+            views.append(chunk[:n])
+            chunks[0] = chunk[n:]
+            n = 0
+    return views
 
 
 class IAP2Stream:
+    """Byte stream on a session of a connection.
+
+    Writes follow the flow control model of asyncio transports: :meth:`write`
+    never blocks, :meth:`drain` pauses once more than the high watermark is
+    buffered and resumes when it fell to the low watermark. Buffered are the
+    bytes not yet handed to the link plus the ones waiting in the link's send
+    queue.
+
+    Written buffers are not copied, packets reference slices of them until
+    they are acknowledged. Buffers must therefore not be modified after
+    writing them.
+
+    Writes shorter than a packet stay buffered until :meth:`drain` unless
+    auto flush is enabled with :meth:`set_auto_flush`.
+
+    Received data is buffered until it is read. With a receive budget set by
+    :meth:`set_receive_budget` the connection stops acknowledging packets for
+    the stream while the budget is used up, see :class:`IAP2Connection`. A
+    reader waiting for more data than buffered lifts the budget, like reading
+    resumes a paused transport in asyncio.
+    """
+
     def __init__(self, conn: "IAP2Connection", session_id: int, stream_id: int = None):
         self.conn = conn
         self.session_id = session_id
         self.stream_id = stream_id
-        self.out_buffer = bytearray()
-        self.in_buffer = bytearray()
-        self.in_waiter_fut = None
-        self.in_waiter_count = None
-        if self.stream_id != None:
-            self.out_buffer += EA_SESSION_ID_STRUCT.pack(self.stream_id)
+        # written buffers not handed to the link yet, as memoryviews
+        self.out_buffer = deque()
+        self._out_size = 0
+        # received payloads not read yet, as memoryviews
+        self.in_buffer = deque()
+        self._in_size = 0
+        self._receive_budget = None
+        self._read_lock = asyncio.Lock()
+        self._read_waiter = None
+        self._prefix = EA_SESSION_ID_STRUCT.pack(stream_id) if stream_id is not None else b''
+        # packets handed to the link which are not sent yet, oldest first
+        self._queued = deque()
+        self._queued_bytes = 0
+        # packets handed to the link which are not acknowledged yet, oldest
+        # first, only tracked during send_file()
+        self._unacked = None
+        self._unacked_bytes = 0
+        self._drain_waiter = None
+        self.set_write_buffer_limits()
+        self._flush_delay = None
+        self._flush_threshold = None
+        self._flush_key = ("flush", session_id, stream_id)
         self.closed = False
 
+    def set_write_buffer_limits(self, high: int = None, low: int = None):
+        if high is None:
+            high = 4 * low if low is not None else DEFAULT_HIGH_WATER
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError(f"high ({high}) must be >= low ({low}) must be >= 0")
+        self._high_water = high
+        self._low_water = low
+
+    def set_auto_flush(self, delay: float = None, threshold: int = None):
+        """Sends small writes without waiting for :meth:`drain`.
+
+        Buffered bytes go out ``delay`` seconds after the first write that was
+        not sent, so writes issued within the delay share a packet, or as soon
+        as ``threshold`` bytes are buffered. A delay of ``None`` turns auto flush
+        off, a delay of 0 flushes once the current timers are processed.
+        """
+        if delay is not None and delay < 0:
+            raise ValueError("delay must be >= 0")
+        if threshold is not None and threshold < 1:
+            raise ValueError("threshold must be >= 1")
+        self._flush_delay = delay
+        self._flush_threshold = threshold
+        if delay is None:
+            self.conn._timers.cancel(self._flush_key)
+            self.conn._pending_flushes.discard(self)
+        elif self._out_size:
+            self._schedule_flush()
+
+    def set_receive_budget(self, budget: int = None):
+        """Limits the received bytes buffered for the stream, ``None`` removes the limit."""
+        if budget is not None and budget < 1:
+            raise ValueError("budget must be >= 1")
+        self._receive_budget = budget
+        if budget is None:
+            self.conn._budgeted_streams.discard(self)
+        else:
+            self.conn._budgeted_streams.add(self)
+        self.conn.resume_receiving()
+
+    def get_receive_buffer_size(self):
+        return self._in_size
+
+    def get_write_buffer_limits(self):
+        return self._low_water, self._high_water
+
+    def get_write_buffer_size(self):
+        queued = self._queued
+        while queued and queued[0].psn is not None:
+            self._queued_bytes -= len(queued.popleft().data)
+        return self._out_size + self._queued_bytes
+
     def write(self, data):
         if self.closed:
             raise IOError("closed")
-        if len(self.out_buffer) == 0:
-            self.out_buffer = data
-        else:
-            self.out_buffer += data
-        while len(self.out_buffer) >= self.conn.lsp.max_len and self.conn.write_allowed_event.is_set():
-            self.conn.send_packet(
-                IAP2Packet(self.out_buffer[:self.conn.lsp.max_len],
-                           session_id=self.session_id))
-            del self.out_buffer[:self.conn.lsp.max_len]
+        if not data:
+            return
+        view = memoryview(data).cast("B")
+        self.out_buffer.append(view)
+        self._out_size += len(view)
+        if self.conn.state == STATE_NORMAL:
+            self._send_buffered(flush=False)
+        if self._flush_delay is not None and self._out_size:
+            if self._flush_threshold is not None and self._out_size >= self._flush_threshold:
+                self._auto_flush()
+            else:
+                self._schedule_flush()
 
     async def drain(self):
         if self.closed:
             raise IOError("closed")
-        if len(self.out_buffer) == 0:
-            return
-        await self.conn.write_allowed_event.wait()
-        self.conn.send_packet(
-            IAP2Packet(self.out_buffer, session_id=self.session_id))
-        self.out_buffer = bytearray()
-        if self.stream_id != None:
-            self.out_buffer += EA_SESSION_ID_STRUCT.pack(self.stream_id)
+        limit = self._high_water
+        while True:
+            if self.conn.state == STATE_NORMAL:
+                self._send_buffered(flush=True)
+                if self.get_write_buffer_size() <= limit:
+                    return
+                limit = self._low_water
+            await self._wait_write_progress()
+            if self.closed:
+                raise IOError("closed")
+
+    async def send_file(self, file, offset: int = 0, count: int = None, progress=None) -> int:
+        """Sends ``count`` bytes of ``file`` from ``offset`` on, by default up to its end.
+
+        The file is memory mapped and packets reference the mapping directly,
+        so memory use does not depend on the file size. ``progress(position)``
+        is called with the file position up to which the peer acknowledged the
+        data, which is where an interrupted transfer can be resumed. Returns
+        the number of bytes sent, once all of them are acknowledged, and moves
+        the file position past them.
+        """
+        await self.drain()
+        size = os.fstat(file.fileno()).st_size
+        end = size if count is None else min(size, offset + count)
+        if offset >= end:
+            return 0
+        max_payload = self.conn.lsp.max_len - LINK_PACKET_HEADER_LENGTH - 1 - len(self._prefix)
+        chunk = max(self._high_water, max_payload)
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        self._unacked = deque()
+        self._unacked_bytes = 0
+        try:
+            position = offset
+            while position < end:
+                n = min(chunk, end - position)
+                self.write(view[position:position + n])
+                position += n
+                await self.drain()
+                if progress:
+                    progress(position - self._out_size - self._pending_ack())
+            # the progress is complete once the peer acknowledged the last bytes
+            while self._pending_ack():
+                await self._wait_write_progress()
+                if self.closed:
+                    raise IOError("closed")
+                if progress:
+                    progress(end - self._pending_ack())
+        finally:
+            self._unacked = None
+            # forgets the packets sent from the send queue meanwhile
+            self.get_write_buffer_size()
+            view.release()
+            # packets not acknowledged yet keep the mapping alive, it is
+            # unmapped once they are dropped
+            with suppress(BufferError):
+                mapped.close()
+        file.seek(end)
+        return end - offset
+
+    def _schedule_flush(self):
+        if self._flush_key not in self.conn._timers:
+            self.conn._timers.schedule(self._flush_key, self.conn._time() + self._flush_delay, self._auto_flush)
+
+    def _auto_flush(self):
+        if self.conn.state == STATE_NORMAL:
+            self._send_buffered(flush=True)
+        elif self._flush_delay is not None and not self.closed:
+            # sent once the link is up
+            self.conn._pending_flushes.add(self)
+
+    def _send_buffered(self, flush: bool):
+        # max_len limits the whole packet, including header and checksum
+        max_payload = self.conn.lsp.max_len - LINK_PACKET_HEADER_LENGTH - 1 - len(self._prefix)
+        while self._out_size >= max_payload or (flush and self._out_size):
+            n = min(self._out_size, max_payload)
+            self._out_size -= n
+            views = take_views(self.out_buffer, n)
+            # only packets assembled from several small writes are copied
+            data = views[0] if len(views) == 1 else b''.join(views)
+            p = IAP2Packet(data, session_id=self.session_id, prefix=self._prefix)
+            self.conn.send_packet(p)
+            if p.psn is None:
+                self._queued.append(p)
+                self._queued_bytes += n
+            if self._unacked is not None:
+                self._unacked.append(p)
+                self._unacked_bytes += n
+        if not self._out_size:
+            self.conn._timers.cancel(self._flush_key)
+
+    def _pending_ack(self) -> int:
+        """Returns the bytes of the tracked packets which are not acknowledged yet."""
+        unacked = self._unacked
+        unack_packets = self.conn._unack_packets
+        # acknowledgements are cumulative, so the oldest packets go first
+        while unacked and unacked[0].psn is not None and unack_packets.get(unacked[0].psn) is not unacked[0]:
+            self._unacked_bytes -= len(unacked.popleft().data)
+        return self._unacked_bytes
+
+    async def _wait_write_progress(self):
+        # concurrent drain() calls share the waiter
+        waiter = self._drain_waiter
+        if waiter is None:
+            waiter = self._drain_waiter = self.conn._get_loop().create_future()
+            self.conn._blocked_streams.add(self)
+        await asyncio.shield(waiter)
+
+    def _write_progress(self):
+        waiter = self._drain_waiter
+        self._drain_waiter = None
+        self.conn._blocked_streams.discard(self)
+        if waiter and not waiter.done():
+            waiter.set_result(True)
 
     def received_data(self, data):
-        self.in_buffer += data
-        if self.in_waiter_fut and self.in_waiter_count <= len(self.in_buffer):
-            self.in_waiter_fut.set_result(True)
-            self.in_waiter_fut = None
+        if not data:
+            return
+        self.in_buffer.append(memoryview(data))
+        self._in_size += len(data)
+        waiter = self._read_waiter
+        if waiter and not waiter.done():
+            waiter.set_result(True)
+
+    async def read(self, n: int = -1):
+        """Returns up to ``n`` bytes of the oldest payload not read yet as a
+        memoryview, an empty one at EOF."""
+        async with self._read_lock:
+            while self._in_size == 0:
+                if self.closed:
+                    return memoryview(b'')
+                await self._wait_for_data()
+            chunk = self.in_buffer[0]
+            return self._take(len(chunk) if n < 0 else min(n, len(chunk)))[0]
+
+    async def readinto(self, buffer):
+        """Reads into ``buffer`` whatever is available, waiting for at least one
+        byte. Returns the number of bytes read, 0 at EOF."""
+        async with self._read_lock:
+            while self._in_size == 0:
+                if self.closed:
+                    return 0
+                await self._wait_for_data()
+            target = memoryview(buffer).cast("B")
+            offset = 0
+            for view in self._take(min(len(target), self._in_size)):
+                target[offset:offset + len(view)] = view
+                offset += len(view)
+            return offset
 
     async def readexactly(self, nbytes):
-        if self.in_waiter_fut:
-            return
+        async with self._read_lock:
+            while self._in_size < nbytes:
+                if self.closed:
+                    raise asyncio.exceptions.IncompleteReadError(partial=b''.join(self._take(self._in_size)),
+                                                                 expected=nbytes)
+                await self._wait_for_data()
+            return b''.join(self._take(nbytes))
+
+    async def readuntil(self, separator=b'\n'):
+        """Reads up to and including ``separator``."""
+        if not separator:
+            raise ValueError("separator must not be empty")
+        async with self._read_lock:
+            start = 0
+            while True:
+                index = self._find(separator, start)
+                if index >= 0:
+                    return b''.join(self._take(index + len(separator)))
+                if self.closed:
+                    raise asyncio.exceptions.IncompleteReadError(partial=b''.join(self._take(self._in_size)),
+                                                                 expected=None)
+                start = max(0, self._in_size - len(separator) + 1)
+                await self._wait_for_data()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    async def _wait_for_data(self):
+        self._read_waiter = self.conn._get_loop().create_future()
+        if self.conn._receive_held:
+            # a reader waiting for more than the budget may exceed it
+            self.conn.resume_receiving()
+        try:
+            await self._read_waiter
+        finally:
+            self._read_waiter = None
+
+    def _take(self, n: int):
+        self._in_size -= n
+        views = take_views(self.in_buffer, n)
+        if self.conn._receive_held:
+            self.conn.resume_receiving()
+        return views
+
+    def _find(self, separator, start: int):
+        """Offset of the first ``separator`` starting at or after ``start``, -1 if none is buffered."""
+        overlap = len(separator) - 1
+        offset = 0
+        tail = b''
+        for chunk in self.in_buffer:
+            end = offset + len(chunk)
+            if end >= start:
+                data = tail + bytes(chunk)
+                data_offset = offset - len(tail)
+                index = data.find(separator, max(0, start - data_offset))
+                if index >= 0:
+                    return data_offset + index
+                tail = data[len(data) - overlap:] if overlap else b''
+            offset = end
+        return -1
 
-        if len(self.in_buffer) < nbytes:
-            if self.closed:
-                raise asyncio.exceptions.IncompleteReadError(partial=self.in_buffer, expected=nbytes)
-            self.in_waiter_count = nbytes
-            fut = self.conn._loop.create_future()
-            self.in_waiter_fut = fut
-            await fut
+    def feed_eof(self):
+        self.closed = True
+        waiter = self._read_waiter
+        if waiter and not waiter.done():
+            waiter.set_result(True)
+        self._write_progress()
+
+
+class IAP2PacketQueue:
+    """Payloads of a session in packet mode, in the order they were received.
+
+    Iterating it yields every payload as a whole until the connection closes.
+    Payloads not taken yet count toward the connection's ``receive_budget``.
+    """
+
+    def __init__(self, conn: "IAP2Connection" = None):
+        self.conn = conn
+        self._payloads = deque()
+        self._in_size = 0
+        # the queue has no budget of its own, only the connection's applies
+        self._receive_budget = None
+        self._read_waiter = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._payloads:
             if self.closed:
-                raise asyncio.exceptions.IncompleteReadError(partial=self.in_buffer, expected=nbytes)
+                raise StopAsyncIteration
+            self._read_waiter = asyncio.get_running_loop().create_future()
+            if self.conn is not None and self.conn._receive_held:
+                # a waiting reader may exceed the budget, as for streams
+                self.conn.resume_receiving()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+        data = self._payloads.popleft()
+        self._in_size -= len(data)
+        if self.conn is not None and self.conn._receive_held:
+            self.conn.resume_receiving()
+        return data
 
-        d = self.in_buffer[:nbytes]
-        del self.in_buffer[:nbytes]
-        return d
+    def received_data(self, data):
+        self._payloads.append(data)
+        self._in_size += len(data)
+        self._wakeup()
 
     def feed_eof(self):
         self.closed = True
-        if self.in_waiter_fut:
-            self.in_waiter_fut.set_result(True)
-            self.in_waiter_fut = None
+        self._wakeup()
 
+    def _wakeup(self):
+        waiter = self._read_waiter
+        if waiter and not waiter.done():
+            waiter.set_result(True)
 
-class IAP2Connection:
+
+class IAP2Link:
+    """Sans-IO iAP2 link layer.
+
+    Holds the complete protocol state (detection, negotiation, acknowledgement
+    and retransmission) but performs no I/O. Bytes read from the transport are
+    passed to :meth:`receive_data` and :meth:`handle_timers` has to be called
+    once :meth:`next_deadline` has passed, both take the current time in
+    seconds. Afterwards :meth:`data_to_send` returns the buffers to write to
+    the transport and :meth:`received_payloads` the payloads received in
+    sequence.
+    """
     CONTROL_SESSION_ID = 10
     EA_SESSION_ID = 11
 
     def __init__(self,
-                 output: asyncio.StreamWriter,
-                 input: asyncio.StreamReader,
-                 loop: asyncio.AbstractEventLoop = asyncio.get_event_loop(),
-                 max_outgoing: int = 30,
+                 max_outgoing: int = None,
                  max_outgoing_delta: int = 0,
-                 ack_timeout=500,
-                 on_error: Callable[[Any], None] = None):
-        self.on_error = on_error
+                 ack_timeout=None,
+                 ack_policy: AckPolicy = None,
+                 congestion_control: bool = False,
+                 hints: LinkHints = None,
+                 timers: DeadlineScheduler = None,
+                 send_scheduler: SendScheduler = None):
+        if hints is None:
+            hints = TRANSPORT_LINK_HINTS["default"]
+        self.hints = hints
+        if ack_policy is None:
+            ack_policy = SessionAckPolicy({IAP2Link.CONTROL_SESSION_ID: ImmediateAckPolicy()},
+                                          default=DelayedAckPolicy())
+        self.ack_policy = ack_policy
         self.state = None
+        self.error = None
+        self.write_allowed = False
         self.lsp = LinkSynchronizationPayload(
-            max_outgoing=max_outgoing,
-            max_len=65535,
-            retransmission_timeout=4000,
-            ack_timeout=ack_timeout,
+            max_outgoing=max_outgoing if max_outgoing is not None else hints.max_outgoing,
+            max_len=hints.max_len,
+            retransmission_timeout=hints.retransmission_timeout,
+            ack_timeout=ack_timeout if ack_timeout is not None else hints.ack_timeout,
             max_retransmissions=4,
             max_ack=3,
             sessions=[
-                LSPSession(id=IAP2Connection.CONTROL_SESSION_ID,
+                LSPSession(id=IAP2Link.CONTROL_SESSION_ID,
                            type=0,
                            version=1),
-                LSPSession(id=IAP2Connection.EA_SESSION_ID, type=2, version=1)
+                LSPSession(id=IAP2Link.EA_SESSION_ID, type=2, version=1)
             ])
         self._max_outgoing_delta = max_outgoing_delta
         self._sent_psn = 99
         self._last_sent_acknowledged_psn = None
-        self._unack_packets = []
-        self._queued_packets = []
+        self._duplicate_acks = 0
+        self._unack_packets = PSNRing()
+        if send_scheduler is None:
+            send_scheduler = SendScheduler(priority_sessions=[IAP2Link.CONTROL_SESSION_ID],
+                                           stream_sessions=[IAP2Link.EA_SESSION_ID])
+        # packets waiting for room in the send window
+        self._queued_packets = send_scheduler
 
         self._last_received_in_sequence_psn = 0
         self._last_acked_psn = None
         self._initial_received_psn = None
-        self._received_out_of_sequence = []
-        self._cumulative_received = 0
-        self._loop = loop
-        self._output = output
-        self._input = input
-        self._send_ack_timer = None
-        self._recv_ack_timer = None
-        self.write_allowed_event = asyncio.Event()
-        self.control_session = IAP2Stream(self,
-                                          IAP2Connection.CONTROL_SESSION_ID)
-        self.ea_streams = dict()
-        self._receive_loop_task = None
-
-    def create_ea_stream(self, stream_id):
-        stream = IAP2Stream(self, IAP2Connection.EA_SESSION_ID, stream_id)
-        self.ea_streams[stream_id] = stream
-        return stream
-
-    def start(self):
+        self._received_out_of_sequence = PSNRing()
+        self._last_eak = set()
+        self._next_eak_time = 0
+        self._in_batch = False
+        # the next in-sequence packet waits for _can_deliver
+        self._receive_held = False
+        # psn -> copies received while held, including retransmissions
+        self._held_copies = dict()
+        self._ack_requested = False
+        self._ack_deferred = False
+        self._eak_requested = False
+        self.batch_size_histogram = Counter()
+        self.retransmissions = 0
+        self._now = 0
+        self._received_marker = bytearray()
+        self._decoder = LinkFrameDecoder(reuse_header=True)
+        self._corked = []
+        self._delivered = []
+        self._timers = timers if timers is not None else DeadlineScheduler()
+        self._rtt = RTTEstimator(self.lsp.retransmission_timeout)
+        self._congestion = AIMDController() if congestion_control else None
+
+    @property
+    def rtt(self):
+        """Smoothed round-trip time in milliseconds, None until measured."""
+        return self._rtt.srtt
+
+    @property
+    def rto(self):
+        """Current retransmission timeout in milliseconds."""
+        return self._rtt.rto
+
+    @property
+    def send_window(self):
+        """Number of packets which may be in flight at once, further ones are queued."""
+        if self._congestion is None:
+            return self.lsp.max_outgoing
+        return self._congestion.window(self.lsp.max_outgoing)
+
+    def start(self, now: float = None):
+        """Starts detecting iAP2 support of the peer."""
         if self.state:
             return
-        self._receive_loop_task = self._loop.create_task(self._receive_loop())
+        self._set_time(now)
         self.state = STATE_DETECT_IAP2_SUPPORT
         self._send_detect_iap2_support()
 
-    def close(self):
-        self._input.feed_eof()
-
-    def _write_packet(self, payload=None, seq=0, control=0, session_id=0):
-        self._cumulative_received = 0
+    def receive_data(self, data, now: float = None):
+        """Handles bytes read from the transport."""
+        self._set_time(now)
+        if self.state == STATE_DETECT_IAP2_SUPPORT:
+            received_marker = self._received_marker
+            missing = len(IAP2_MARKER) - len(received_marker)
+            received_marker += data[:missing]
+            data = data[missing:]
+            if len(received_marker) < len(IAP2_MARKER) or not self._receive_marker(bytes(received_marker)):
+                return
+        if data and (self.state == STATE_NEGOTIATE or self.state == STATE_NORMAL):
+            self._decoder.feed(data)
+            self._handle_packets(self._decoder)
+
+    def handle_timers(self, now: float = None):
+        """Runs the timers which are due at ``now``."""
+        self._set_time(now)
+        self._timers.run_due(self._time())
+
+    def next_deadline(self):
+        """Time at which :meth:`handle_timers` has to be called next, None if no timer is pending."""
+        return self._timers.next_deadline()
+
+    def data_to_send(self):
+        """Returns the buffers to be written to the transport, in order."""
+        buffers = self._corked
+        self._corked = []
+        return buffers
+
+    def received_payloads(self):
+        """Returns the ``(session_id, payload)`` pairs received in sequence."""
+        delivered = self._delivered
+        self._delivered = []
+        return delivered
+
+    def resume_receiving(self, now: float = None):
+        """Delivers packets held back by :meth:`_can_deliver` once the receiver has room again."""
+        if not self._receive_held or self.state == STATE_DEAD:
+            return
+        self._set_time(now)
+        self._receive_held = False
+        last = self._last_received_in_sequence_psn
+        self._deliver_in_sequence()
+        if self._last_received_in_sequence_psn != last:
+            # the peer's window may be full with the held packets
+            self._ack_requested = True
+        self._flush_acks()
+
+    def _set_time(self, now):
+        if now is not None:
+            self._now = now
+
+    def _time(self):
+        return self._now
+
+    def _allow_write(self, allowed: bool):
+        self.write_allowed = allowed
+
+    def _packets_acknowledged(self):
+        """Called after the peer acknowledged sent packets."""
+        pass
+
+    def _write_packet(self, payload=None, seq=0, control=0, session_id=0, payload_checksum=None, prefix=b''):
         if payload:
-            length = len(payload) + 10
+            length = len(prefix) + len(payload) + 10
         else:
             length = 9
         header = LinkPacketHeader(control=control,
@@ -255,267 +820,670 @@ class IAP2Connection:
                                   seq=seq,
                                   ack=self._last_received_in_sequence_psn,
                                   session_id=session_id)
-        print(">", header, payload)
+        logger.debug("> %s %s", header, payload)
         header_bytes = header.pack()
         if payload:
-            self._output.write(header_bytes + payload +
-                               bytes([gen_checksum(payload)]))
-
+            if payload_checksum is None:
+                payload_checksum = Checksum(prefix).update(payload).digest() if prefix else gen_checksum(payload)
+            if prefix:
+                self._write(header_bytes, prefix, payload, CHECKSUM_BYTES[payload_checksum])
+            else:
+                self._write(header_bytes, payload, CHECKSUM_BYTES[payload_checksum])
         else:
-            self._output.write(header_bytes)
+            self._write(header_bytes)
+
+    def _write(self, *buffers):
+        self._corked.extend(buffers)
 
     def _send_ack(self):
         self._write_packet(seq=self._sent_psn, control=CONTROL_ACK)
 
     def _send_eak(self, num):
-        self._write_packet(bytes(num), seq=self._sent_psn, control=CONTROL_EAK)
+        # with the ACK bit set the EAK carries the cumulative ACK as well
+        self._write_packet(bytes(num), seq=self._sent_psn, control=CONTROL_ACK | CONTROL_EAK)
 
     def _send_data(self, p):
+        if p.checksum is None:
+            p.checksum = Checksum(p.prefix).update(p.data).digest() if p.prefix else gen_checksum(p.data)
         self._write_packet(p.data,
                            seq=p.psn,
                            control=CONTROL_ACK,
-                           session_id=p.session_id)
+                           session_id=p.session_id,
+                           payload_checksum=p.checksum,
+                           prefix=p.prefix)
 
     def _send_detect_iap2_support(self):
         if self.state != STATE_DETECT_IAP2_SUPPORT:
             return
-        self._output.write(IAP2_MARKER)
-        self._loop.call_later(1, self._send_detect_iap2_support)
+        self._write(IAP2_MARKER)
+        self._timers.schedule("detect", self._time() + 1, self._send_detect_iap2_support)
 
     def _send_negotiate(self):
         if self.state != STATE_NEGOTIATE:
             return
         lsp_bytes = self.lsp.pack()
         self._write_packet(lsp_bytes, self._sent_psn, CONTROL_SYN)
-        self._loop.call_later(0.5, self._send_negotiate)
-
-    async def _receive_loop(self):
+        self._timers.schedule("negotiate", self._time() + 0.5, self._send_negotiate)
+
+    def _receive_marker(self, marker):
+        if marker != IAP2_MARKER:
+            self._bailout("IAP2 not supported")
+            return False
+        self._timers.cancel("detect")
+        self.state = STATE_NEGOTIATE
+        self._send_negotiate()
+        return True
+
+    def _handle_packets(self, packets):
+        """Handles a batch of received packets, answering them with at most one ACK or EAK."""
+        self._in_batch = True
+        count = 0
         try:
-            recv_marker = await self._input.readexactly(len(IAP2_MARKER))
-            if recv_marker != IAP2_MARKER:
-                self._bailout("IAP2 not supported")
+            for header, payload in packets:
+                self._handle_packet(header, payload)
+                count += 1
+        finally:
+            self._in_batch = False
+        if count:
+            self.batch_size_histogram[count] += 1
+        self._flush_acks()
+
+    def _handle_packet(self, header: LinkPacketHeader, payload):
+        logger.debug("< %s %s", header, payload)
+        if (header.control & CONTROL_RST) != 0:
+            self._bailout("device sent reset message")
+        if (header.control & CONTROL_SYN) != 0:
+            lsp = LinkSynchronizationPayload.from_bytes(payload)
+            if not lsp:
                 return
-            if hasattr(self._input, "reset"):
-                self._input.reset()
-            self.state = STATE_NEGOTIATE
-            self._send_negotiate()
-            while True:
-                header_bytes = await self._input.readexactly(9)
-                while True:
-                    if int(header_bytes[0]) << 8 | int(
-                            header_bytes[1]) == LinkPacketHeader.start:
-                        break
-                    header_bytes = header_bytes[1:] + await self._input.readexactly(
-                        1)
-                header = LinkPacketHeader.from_bytes(header_bytes)
-                if not header:
-                    continue
-                payload = None
-                if header.length > 9:
-                    payload_with_checksum = await self._input.readexactly(
-                        header.length - 9)
-                    if not check_checksum(payload_with_checksum):
-                        continue
-                    payload = payload_with_checksum[:-1]
-                print("<", header, payload)
-                if hasattr(self._input, "reset"):
-                    self._input.reset()
-                if (header.control & CONTROL_RST) != 0:
-                    self._bailout("device sent reset message")
-                if (header.control & CONTROL_SYN) != 0:
-                    lsp = LinkSynchronizationPayload.from_bytes(payload)
-                    if not lsp:
-                        continue
-                    self._handle_syn(lsp, header.seq)
-                if (header.control & CONTROL_ACK) != 0:
-                    self._cumulative_received += 1
-                    self._handle_ack(header.ack)
-                if (header.control & CONTROL_EAK) != 0 and payload:
-                    self._handle_eak([int(x) for x in payload])
-                if (header.control & ~CONTROL_ACK) == 0 and payload != None:
-                    self._handle_data(
-                        IAP2Packet(payload, header.seq, header.session_id))
-                if self._cumulative_received >= self.lsp.max_ack:
-                    self._cumulative_received = 0
-                    self._last_acked_psn = self._last_received_in_sequence_psn
-                    self._send_ack()
-        except asyncio.exceptions.IncompleteReadError:
-            self._bailout(None)
-        except Exception as e:
-            self._bailout(e)
+            self._handle_syn(lsp, header.seq)
+        if (header.control & CONTROL_ACK) != 0:
+            self._handle_ack(header.ack, pure_ack=header.control == CONTROL_ACK and payload is None)
+        if (header.control & CONTROL_EAK) != 0 and payload:
+            self._handle_eak([int(x) for x in payload])
+        if (header.control & ~CONTROL_ACK) == 0 and payload != None:
+            self._handle_data(
+                IAP2Packet(payload, header.seq, header.session_id))
 
     def _bailout(self, error):
         if self.state == STATE_DEAD:
             return
-        self._disarm_send_ack_timer()
-        self._disarm_recv_ack_timer()
+        self._timers.close()
         self.state = STATE_DEAD
-        try:
-            self._output.close()
-        except:
-            pass
-        try:
-            self.control_session.feed_eof()
-            for stream in self.ea_streams.values():
-                stream.feed_eof()
-        except:
-            pass
-        if self._receive_loop_task:
-            try:
-                self._receive_loop_task.cancel()
-            except:
-                pass
-        if error is not None and self.on_error:
-            self.on_error(error)
+        self.error = error
 
-    def send_packet(self, p: IAP2Packet):
-        if distance(self._sent_psn, self._last_sent_acknowledged_psn
-                    ) > self.lsp.max_outgoing or self.state != STATE_NORMAL:
+    def send_packet(self, p: IAP2Packet, now: float = None):
+        self._set_time(now)
+        if len(self._queued_packets) != 0 or distance(self._sent_psn, self._last_sent_acknowledged_psn
+                                                      ) >= self.send_window or self.state != STATE_NORMAL:
             self._queued_packets.append(p)
-            self.write_allowed_event.clear()
+            self._allow_write(False)
             return
+        self._transmit(p)
 
+    def _transmit(self, p: IAP2Packet):
         self._sent_psn = signed_add(self._sent_psn, 1)
         p.counter = 0
+        p.fast_retransmits = 0
+        p.fast_retransmit_time = 0
         p.psn = self._sent_psn
-        p.timeout = self._loop.time() + self.lsp.retransmission_timeout / 1000
-        self._disarm_send_ack_timer()
+        p.sent_at = self._time()
+        p.timeout = p.sent_at + self._rtt.rto / 1000
+        self._piggyback_ack()
         self._send_data(p)
-        self._last_acked_psn = self._last_received_in_sequence_psn
-        self._rearm_recv_ack_timer(p.timeout)
-        self._unack_packets.append(p)
+        self._unack_packets.put(p.psn, p)
+        self._rearm_recv_ack_timer(p)
 
     def _handle_syn(self, lsp: LinkSynchronizationPayload, psn: int):
         if self.state != STATE_NEGOTIATE:
             return
-        print("Device:", lsp)
-        print("Accessory:", self.lsp)
+        logger.debug("Device: %s", lsp)
+        logger.debug("Accessory: %s", self.lsp)
         self.lsp = lsp
+        # the peer may hold back its ACK for up to ack_timeout
+        self._rtt.set_bounds(max(MIN_RETRANSMISSION_TIMEOUT, lsp.ack_timeout),
+                             lsp.retransmission_timeout)
         self._last_received_in_sequence_psn = psn
         self._last_acked_psn = psn
         self._send_ack()
 
-    def _handle_ack(self, num: int):
+    def _handle_ack(self, num: int, pure_ack: bool = False):
         if self.state == STATE_NEGOTIATE:
+            self._timers.cancel("negotiate")
             self.state = STATE_NORMAL
-            self.write_allowed_event.set()
+            self._allow_write(True)
+        if num != self._last_sent_acknowledged_psn:
+            self._duplicate_acks = 0
+        elif pure_ack and len(self._unack_packets) != 0:
+            self._duplicate_acks += 1
+            if self._duplicate_acks >= DUPLICATE_ACK_THRESHOLD:
+                p = self._unack_packets.get(signed_add(num, 1))
+                if p is not None:
+                    self._fast_retransmit(p)
         self._last_sent_acknowledged_psn = num
 
-        while len(self._unack_packets) != 0:
-            d = distance(
-                self._unack_packets[0].psn,
-                self._last_sent_acknowledged_psn)
+        acked = 0
+        for psn in self._unack_packets.psns(signed_add(self._sent_psn, 1)):
+            d = distance(psn, self._last_sent_acknowledged_psn)
             if 0 < d <= self.lsp.max_ack + 10:
-                self._rearm_recv_ack_timer(self._unack_packets[0].timeout)
                 break
-            else:
-                del self._unack_packets[0]
-        else:
-            self._disarm_recv_ack_timer()
-
+            p = self._unack_packets.pop(psn)
+            self._disarm_recv_ack_timer(psn)
+            acked += 1
+            # Karn's rule: acks of retransmitted packets are ambiguous
+            if psn == num and p.counter == 0 and p.fast_retransmits == 0:
+                self._rtt.sample((self._time() - p.sent_at) * 1000)
+        if acked:
+            if self._congestion is not None:
+                self._congestion.on_ack(acked, self.lsp.max_outgoing)
+            self._packets_acknowledged()
+
+        transmitted = False
         while distance(self._sent_psn, self._last_sent_acknowledged_psn
-                       ) < self.lsp.max_outgoing and len(
+                       ) < self.send_window and len(
             self._queued_packets) > 0:
-            self.send_packet(self._queued_packets.pop(0))
-            self.write_allowed_event.set()
-
-    def _on_expect_ack_timer(self):
-        if len(self._unack_packets) == 0 or self.state != STATE_NORMAL:
+            self._transmit(self._queued_packets.popleft())
+            transmitted = True
+        if transmitted:
+            self._allow_write(True)
+
+    def _on_expect_ack_timer(self, psn: int):
+        p = self._unack_packets.get(psn)
+        if p is None or self.state != STATE_NORMAL:
             return
-        unack_packets = sorted(self._unack_packets, key=lambda x: x.timeout)
-        p = unack_packets[0]
-        p.timeout = self._loop.time() + self.lsp.retransmission_timeout / 1000
+        self._rtt.backoff()
+        self._on_loss()
+        p.timeout = self._time() + self._rtt.rto / 1000
         p.counter += 1
         if p.counter == self.lsp.max_retransmissions:
             self._bailout(p)
             return
+        self.retransmissions += 1
+        self._piggyback_ack()
         self._send_data(p)
-        self._rearm_recv_ack_timer(unack_packets[0 if len(unack_packets) == 1 else 1].timeout)
+        self._rearm_recv_ack_timer(p)
 
     def _handle_eak(self, nums: List[int]):
         if self.state != STATE_NORMAL:
             return
-        for p in self._unack_packets:
-            if p.psn in nums:
-                p.counter += 1
-                if p.counter == self.lsp.max_retransmissions:
-                    self._bailout(p)
-                    continue
-                self._send_data(p)
-                self._disarm_send_ack_timer()
-                self._rearm_recv_ack_timer(p.timeout)
+        for psn in nums:
+            p = self._unack_packets.get(psn)
+            if p is not None:
+                self._fast_retransmit(p)
+
+    def _fast_retransmit(self, p: IAP2Packet):
+        """Retransmits a packet reported lost without waiting for its timeout.
+
+        Each packet is fast retransmitted at most once per round trip. Fast
+        retransmissions do not count against max_retransmissions, only
+        timeouts do.
+        """
+        now = self._time()
+        if now < p.fast_retransmit_time:
+            return
+        p.fast_retransmits += 1
+        self.retransmissions += 1
+        self._on_loss()
+        p.fast_retransmit_time = now + max(self._rtt.srtt or self._rtt.rto, MIN_RETRANSMISSION_TIMEOUT) / 1000
+        p.timeout = now + self._rtt.rto / 1000
+        self._piggyback_ack()
+        self._send_data(p)
+        self._rearm_recv_ack_timer(p)
+
+    def _on_loss(self):
+        if self._congestion is not None:
+            self._congestion.on_loss(self._time(), (self._rtt.srtt or self._rtt.rto) / 1000)
 
     def _on_send_ack_timer(self):
         if self.state != STATE_NORMAL:
             return
         self._last_acked_psn = self._last_received_in_sequence_psn
+        self.ack_policy.on_ack(timer=True)
         self._send_ack()
 
+    def _piggyback_ack(self):
+        """Lets the next outgoing data packet carry the pending ACK."""
+        if self._last_acked_psn == self._last_received_in_sequence_psn:
+            return
+        self._disarm_send_ack_timer()
+        self._last_acked_psn = self._last_received_in_sequence_psn
+        self.ack_policy.on_ack(timer=False)
+
     def _handle_data(self, p: IAP2Packet):
         d = distance(p.psn, self._last_received_in_sequence_psn)
         if d > self.lsp.max_outgoing + 10 or d == 0:
-            self._send_ack()
-            return
-
+            self._ack_requested = True
+        else:
+            self._receive_in_window(p, d)
+        if not self._in_batch:
+            self._flush_acks()
+
+    def _receive_in_window(self, p: IAP2Packet, d: int):
+        received_out_of_sequence = self._received_out_of_sequence
+        duplicate = p.psn in received_out_of_sequence
+        received_out_of_sequence.put(p.psn, p)
+        if self._receive_held and duplicate:
+            copies = self._held_copies[p.psn] = self._held_copies.get(p.psn, 1) + 1
+            # the peer resets the link once the last retransmission of any
+            # packet times out
+            if copies >= max(self.lsp.max_retransmissions - 1, 1):
+                logger.warning("receiver out of room for too long, delivering held packets")
+                self._receive_held = False
+                self._deliver_in_sequence(force=True)
+                self._ack_requested = True
         if d > 1:
-            self._received_out_of_sequence.append(p)
-            if d >= self.lsp.max_outgoing:
-                eak = []
-                x = self._last_received_in_sequence_psn
-                while distance(p.psn, x) > 1:
-                    x = signed_add(x, 1)
-                    eak.append(x)
-                self._disarm_send_ack_timer()
-                self._send_eak(eak)
+            self._eak_requested = True
             return
-
-        self._received_out_of_sequence.append(p)
-        for pp in sorted(self._received_out_of_sequence,
-                         key=lambda x: distance(
-                             x.psn, self._last_received_in_sequence_psn)):
-            if distance(pp.psn, self._last_received_in_sequence_psn) > 1:
-                break
+        if not self._receive_held:
+            self._deliver_in_sequence()
+        if len(received_out_of_sequence) != 0:
+            self._eak_requested = True
+
+    def _deliver_in_sequence(self, force: bool = False):
+        """Delivers the packets following the last one received in sequence.
+
+        A packet :meth:`_can_deliver` refuses stops the delivery. It stays in
+        the window and is not acknowledged, so the peer runs out of window and
+        retransmits until :meth:`resume_receiving` is called. As iAP2 has no
+        way to pause the peer, the held packets are forced through before the
+        peer would give up on them, the receiver's limit is a soft one.
+        """
+        received_out_of_sequence = self._received_out_of_sequence
+        next_psn = signed_add(self._last_received_in_sequence_psn, 1)
+        while next_psn in received_out_of_sequence:
+            if not force and not self._can_deliver(received_out_of_sequence.get(next_psn)):
+                logger.debug("holding back packet %d", next_psn)
+                # copies counted before stay, a reader taking data without
+                # getting below the budget does not reset the peer's retries
+                self._receive_held = True
+                return
+            pp = received_out_of_sequence.pop(next_psn)
+            if self._held_copies:
+                self._held_copies.pop(next_psn, None)
             self._received_data(pp)
-            self._last_received_in_sequence_psn = pp.psn
-            self._received_out_of_sequence.remove(pp)
+            self._last_received_in_sequence_psn = next_psn
+            next_psn = signed_add(next_psn, 1)
+            pending = distance(self._last_received_in_sequence_psn, self._last_acked_psn)
+            if self.ack_policy.on_data(self, pp.session_id, pending):
+                self._ack_requested = True
+            else:
+                self._ack_deferred = True
+
+    def _flush_acks(self):
+        """Sends the ACK or EAK the packets received since the last flush call for."""
+        ack_requested = self._ack_requested
+        ack_deferred = self._ack_deferred
+        eak_requested = self._eak_requested
+        self._ack_requested = self._ack_deferred = self._eak_requested = False
+        if self.state == STATE_DEAD:
+            return
+        eak_sent = eak_requested and self._request_missing()
+        if eak_sent or ack_requested:
+            self._mark_acknowledged()
+            # the EAK already carries the cumulative ACK
+            if not eak_sent:
+                self._send_ack()
+        elif ack_deferred:
+            self._rearm_send_ack_timer()
 
-        if distance(self._last_received_in_sequence_psn, self._last_acked_psn
-                    ) >= self.lsp.max_outgoing - self._max_outgoing_delta:
-            self._disarm_send_ack_timer()
+    def _mark_acknowledged(self):
+        self._disarm_send_ack_timer()
+        if self._last_acked_psn != self._last_received_in_sequence_psn:
             self._last_acked_psn = self._last_received_in_sequence_psn
-            self._send_ack()
-        else:
-            self._rearm_send_ack_timer()
+            self.ack_policy.on_ack(timer=False)
+
+    def _request_missing(self):
+        """Sends an EAK listing the gaps before the out-of-sequence packets held.
+
+        A further EAK is only sent within one round trip if it asks for PSNs
+        which were not requested yet. Returns whether an EAK was sent.
+        """
+        received_out_of_sequence = self._received_out_of_sequence
+        if len(received_out_of_sequence) == 0:
+            return False
+        next_psn = signed_add(self._last_received_in_sequence_psn, 1)
+        end = signed_add(received_out_of_sequence.last(next_psn), 1)
+        missing = list(received_out_of_sequence.missing(next_psn, end))
+        if not missing:
+            return False
+        now = self._time()
+        if now < self._next_eak_time and self._last_eak.issuperset(missing):
+            return False
+        interval = max(self._rtt.srtt or self.lsp.ack_timeout, MIN_RETRANSMISSION_TIMEOUT)
+        self._next_eak_time = now + interval / 1000
+        self._last_eak = set(missing)
+        self._disarm_send_ack_timer()
+        self._send_eak(missing)
+        return True
+
+    def _can_deliver(self, p: IAP2Packet) -> bool:
+        """Returns whether the receiver has room for ``p``, see :meth:`_deliver_in_sequence`."""
+        return True
 
     def _received_data(self, p: IAP2Packet):
-        if p.session_id == IAP2Connection.CONTROL_SESSION_ID:
-            self.control_session.received_data(p.data)
-        elif p.session_id == IAP2Connection.EA_SESSION_ID and len(p.data) >= 2:
-            stream_id = EA_SESSION_ID_STRUCT.unpack(p.data[:2])[0]
-            stream = self.ea_streams.get(stream_id)
-            if stream:
-                stream.received_data(p.data[2:])
+        self._delivered.append((p.session_id, p.data))
 
     def _disarm_send_ack_timer(self):
-        if self._send_ack_timer:
-            self._send_ack_timer.cancel()
-            self._send_ack_timer = None
+        self._timers.cancel("send_ack")
 
     def _rearm_send_ack_timer(self):
-        if self._send_ack_timer:
-            self._send_ack_timer.cancel()
-        self._send_ack_timer = self._loop.call_later(self.lsp.ack_timeout / 1000,
-                                                     self._on_send_ack_timer)
-
-    def _disarm_recv_ack_timer(self):
-        if self._recv_ack_timer:
-            self._recv_ack_timer.cancel()
-            self._recv_ack_timer = None
-
-    def _rearm_recv_ack_timer(self, time):
-        if self._recv_ack_timer:
-            self._recv_ack_timer.cancel()
-        self._recv_ack_timer = self._loop.call_at(time, self._on_expect_ack_timer)
+        self._timers.schedule("send_ack", self._time() + self.lsp.ack_timeout / 1000,
+                              self._on_send_ack_timer)
+
+    def _disarm_recv_ack_timer(self, psn: int):
+        self._timers.cancel(psn)
+
+    def _rearm_recv_ack_timer(self, p: IAP2Packet):
+        self._timers.schedule(p.psn, p.timeout, self._on_expect_ack_timer, p.psn)
+
+
+class IAP2Connection(IAP2Link):
+    """asyncio adapter running an :class:`IAP2Link` on a StreamReader/StreamWriter pair.
+
+    Without an explicit ``loop`` the connection binds to the running loop the
+    first time it needs one, usually in :meth:`start`.
+
+    ``receive_budget`` limits the received bytes buffered in all streams and
+    packet queues together, :meth:`IAP2Stream.set_receive_budget` those of a
+    single stream. Payloads passed to packet mode callbacks are not buffered
+    by the connection and do not count.
+    A packet for a stream over budget is held back unacknowledged, so the
+    peer's send window throttles it until the stream is read. As packets are
+    acknowledged in sequence, this holds back the following packets of all
+    sessions as well.
+    """
+
+    def __init__(self,
+                 output: asyncio.StreamWriter,
+                 input: asyncio.StreamReader,
+                 loop: asyncio.AbstractEventLoop = None,
+                 max_outgoing: int = None,
+                 max_outgoing_delta: int = 0,
+                 ack_timeout=None,
+                 on_error: Callable[[Any], None] = None,
+                 ack_policy: AckPolicy = None,
+                 congestion_control: bool = False,
+                 hints: LinkHints = None,
+                 on_close: Callable[[], None] = None,
+                 send_scheduler: SendScheduler = None,
+                 receive_budget: int = None):
+        if hints is None:
+            # the receive side determines max_len, so its hints take precedence
+            hints = getattr(input, "link_hints", None) or getattr(output, "link_hints", None)
+        self.write_allowed_event = asyncio.Event()
+        super().__init__(max_outgoing=max_outgoing,
+                         max_outgoing_delta=max_outgoing_delta,
+                         ack_timeout=ack_timeout,
+                         ack_policy=ack_policy,
+                         congestion_control=congestion_control,
+                         hints=hints,
+                         timers=DeadlineScheduler(loop),
+                         send_scheduler=send_scheduler)
+        self.on_error = on_error
+        self.on_close = on_close
+        self._loop = loop
+        self._output = output
+        self._input = input
+        self._flush_scheduled = False
+        # streams waiting in drain() for the send queue to move
+        self._blocked_streams = set()
+        # auto flushing streams which buffered writes before the link was up
+        self._pending_flushes = set()
+        self.control_session = IAP2Stream(self,
+                                          IAP2Connection.CONTROL_SESSION_ID)
+        self.ea_streams = dict()
+        # bytes of EA data kept for streams not created yet, 0 drops it
+        self.pending_ea_limit = 0
+        self._pending_ea = dict()
+        self._pending_ea_size = 0
+        self.receive_budget = receive_budget
+        self._budgeted_streams = set()
+        # (session id, stream id) -> callback taking the payloads in packet mode
+        self._packet_callbacks = dict()
+        self._packet_queues = dict()
+        self._receive_loop_task = None
+
+    def create_ea_stream(self, stream_id, weight: int = None):
+        """Creates the stream for ``stream_id``, ``weight`` sets its share of the
+        send window relative to the other EA streams.
+
+        Data received for the stream before, up to ``pending_ea_limit`` bytes
+        for all unknown streams together, is passed to it.
+        """
+        if weight is not None:
+            self._queued_packets.set_weight(IAP2Connection.EA_SESSION_ID, stream_id, weight)
+        stream = IAP2Stream(self, IAP2Connection.EA_SESSION_ID, stream_id)
+        self.ea_streams[stream_id] = stream
+        for data in self._pending_ea.pop(stream_id, ()):
+            self._pending_ea_size -= len(data)
+            stream.received_data(data)
+        return stream
+
+    def close_ea_stream(self, stream_id):
+        """Removes the stream for ``stream_id``, its reader sees the end of the stream."""
+        self.stop_receive_packets(IAP2Connection.EA_SESSION_ID, stream_id)
+        # the stream id may be reused by a later session
+        remove_weight = getattr(self._queued_packets, "remove_weight", None)
+        if remove_weight is not None:
+            remove_weight(IAP2Connection.EA_SESSION_ID, stream_id)
+        for data in self._pending_ea.pop(stream_id, ()):
+            self._pending_ea_size -= len(data)
+        stream = self.ea_streams.pop(stream_id, None)
+        if stream:
+            self._budgeted_streams.discard(stream)
+            stream.feed_eof()
+            self.resume_receiving()
+        return stream
+
+    def receive_packets(self, session_id, stream_id=None, callback=None):
+        """Switches a session, or a single EA stream, to packet mode.
+
+        Every in-order payload is passed on as a whole instead of being
+        appended to the stream's buffer; EA payloads without their stream id.
+        Without a ``stream_id`` the EA session gets the payloads of all
+        streams that are neither created nor in packet mode themselves,
+        starting with their stream id. With a ``callback`` it is called with each payload, otherwise an
+        :class:`IAP2PacketQueue` to iterate over is returned. Data the stream
+        buffered before stays in it.
+        """
+        key = (session_id, stream_id)
+        self.stop_receive_packets(session_id, stream_id)
+        if callback is not None:
+            self._packet_callbacks[key] = callback
+            return None
+        queue = self._packet_queues[key] = IAP2PacketQueue(self)
+        self._packet_callbacks[key] = queue.received_data
+        return queue
+
+    def stop_receive_packets(self, session_id, stream_id=None):
+        """Delivers the payloads to the stream again, an iterator in packet mode ends."""
+        key = (session_id, stream_id)
+        self._packet_callbacks.pop(key, None)
+        queue = self._packet_queues.pop(key, None)
+        if queue is not None:
+            queue.feed_eof()
+            # its payloads no longer count toward the budget
+            self.resume_receiving()
+
+    def start(self):
+        if self.state:
+            return
+        self._receive_loop_task = self._get_loop().create_task(self._receive_loop())
+        super().start()
+
+    def close(self):
+        self._input.feed_eof()
+
+    def abort(self):
+        """Tears the connection down immediately."""
+        self._bailout(None)
+
+    async def wait_closed(self):
+        """Waits until the connection has shut down."""
+        if self._receive_loop_task:
+            await asyncio.wait([self._receive_loop_task])
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._timers.attach(self._loop)
+        return self._loop
+
+    def _time(self):
+        if self._loop is None:
+            try:
+                self._get_loop()
+            except RuntimeError:
+                # not bound yet, asyncio loops use the monotonic clock too
+                return time.monotonic()
+        return self._loop.time()
+
+    def _allow_write(self, allowed: bool):
+        super()._allow_write(allowed)
+        if allowed:
+            self.write_allowed_event.set()
+            if self._pending_flushes and self.state == STATE_NORMAL:
+                streams = list(self._pending_flushes)
+                self._pending_flushes.clear()
+                for stream in streams:
+                    if not stream.closed:
+                        stream._auto_flush()
+            for stream in list(self._blocked_streams):
+                stream._write_progress()
+        else:
+            self.write_allowed_event.clear()
+
+    def _packets_acknowledged(self):
+        # wakes send_file() waiting for the acknowledgement of its last packets
+        for stream in list(self._blocked_streams):
+            if stream._unacked is not None:
+                stream._write_progress()
+
+    def _write(self, *buffers):
+        """Queues buffers for output, everything written in one loop iteration
+        is handed to the transport at once.
+
+        Outputs without ``writelines`` are message based, e.g. HID, where every
+        write becomes one message. They get one write per link packet instead.
+        """
+        if not hasattr(self._output, "writelines"):
+            if self.state != STATE_DEAD:
+                self._output.write(b''.join(buffers))
+            return
+        self._corked.extend(buffers)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._get_loop().call_soon(self._flush_output)
+
+    def _flush_output(self):
+        self._flush_scheduled = False
+        if not self._corked or self.state == STATE_DEAD:
+            return
+        self._output.writelines(self.data_to_send())
+
+    async def _receive_loop(self):
+        try:
+            recv_marker = await self._input.readexactly(len(IAP2_MARKER))
+            if hasattr(self._input, "reset"):
+                self._input.reset()
+            self.receive_data(recv_marker)
+            while self.state != STATE_DEAD:
+                data = await self._input.read(READ_CHUNK_SIZE)
+                if not data:
+                    self._bailout(None)
+                    return
+                self.receive_data(data)
+        except asyncio.exceptions.IncompleteReadError:
+            self._bailout(None)
+        except Exception as e:
+            self._bailout(e)
+
+    def _bailout(self, error):
+        if self.state == STATE_DEAD:
+            return
+        try:
+            self._flush_output()
+        except:
+            pass
+        super()._bailout(error)
+        try:
+            self._output.close()
+        except:
+            pass
+        try:
+            self.control_session.feed_eof()
+            for stream in self.ea_streams.values():
+                stream.feed_eof()
+            for queue in self._packet_queues.values():
+                queue.feed_eof()
+        except:
+            pass
+        if self._receive_loop_task:
+            try:
+                self._receive_loop_task.cancel()
+            except:
+                pass
+        if error is not None and self.on_error:
+            self.on_error(error)
+        if self.on_close:
+            self.on_close()
+
+    def _can_deliver(self, p: IAP2Packet) -> bool:
+        if self.receive_budget is None and not self._budgeted_streams:
+            return True
+        stream = self._receiving_stream(p)
+        if stream is None or stream._read_waiter is not None:
+            return True
+        if stream._receive_budget is not None and stream._in_size >= stream._receive_budget:
+            return False
+        if self.receive_budget is not None:
+            buffered = self.control_session._in_size + sum(s._in_size for s in self.ea_streams.values()) \
+                + sum(q._in_size for q in self._packet_queues.values())
+            return buffered < self.receive_budget
+        return True
+
+    def _receiving_stream(self, p: IAP2Packet):
+        """Returns the stream or packet queue buffering ``p``, None for packet
+        mode callbacks or unknown streams."""
+        if p.session_id == IAP2Connection.EA_SESSION_ID and len(p.data) >= 2:
+            stream_id = EA_SESSION_ID_STRUCT.unpack_from(p.data)[0]
+            key = (p.session_id, stream_id)
+            if key not in self._packet_callbacks:
+                stream = self.ea_streams.get(stream_id)
+                if stream is not None:
+                    return stream
+                key = (p.session_id, None)
+            return self._packet_queues.get(key)
+        key = (p.session_id, None)
+        if p.session_id == IAP2Connection.CONTROL_SESSION_ID and key not in self._packet_callbacks:
+            return self.control_session
+        return self._packet_queues.get(key)
+
+    def _received_data(self, p: IAP2Packet):
+        if p.session_id == IAP2Connection.EA_SESSION_ID and len(p.data) >= 2:
+            stream_id = EA_SESSION_ID_STRUCT.unpack_from(p.data)[0]
+            callback = self._packet_callbacks.get((p.session_id, stream_id))
+            stream = self.ea_streams.get(stream_id)
+            session_callback = self._packet_callbacks.get((p.session_id, None))
+            if callback:
+                callback(memoryview(p.data)[2:])
+            elif stream:
+                stream.received_data(memoryview(p.data)[2:])
+            elif session_callback:
+                # the stream id stays in front, as it tells the streams apart
+                session_callback(p.data)
+            elif self._pending_ea_size + len(p.data) - 2 <= self.pending_ea_limit:
+                # the stream may be created once the control session is read
+                self._pending_ea.setdefault(stream_id, []).append(memoryview(p.data)[2:])
+                self._pending_ea_size += len(p.data) - 2
+            else:
+                logger.debug("dropping data for unknown EA stream %d", stream_id)
+            return
+        callback = self._packet_callbacks.get((p.session_id, None))
+        if callback:
+            callback(p.data)
+        elif p.session_id == IAP2Connection.CONTROL_SESSION_ID:
+            self.control_session.received_data(p.data)
 
 
 def distance(a: int, b: int):
@@ -0,0 +1,80 @@
+__all__ = ["PSNRing"]
+
+PSN_COUNT = 256
+_ALL_SLOTS = (1 << PSN_COUNT) - 1
+
+
+class PSNRing:
+    """Packet store with one slot per 8-bit packet sequence number.
+
+    Occupied slots are tracked in a 256 bit bitmap, so walking a window only
+    touches the occupied slots and finding gaps needs no sorting.
+    """
+    __slots__ = ("_slots", "_bitmap", "_count")
+
+    def __init__(self):
+        self._slots = [None] * PSN_COUNT
+        self._bitmap = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, psn):
+        return (self._bitmap >> psn) & 1 == 1
+
+    def get(self, psn):
+        return self._slots[psn]
+
+    def put(self, psn, item):
+        bit = 1 << psn
+        if not self._bitmap & bit:
+            self._bitmap |= bit
+            self._count += 1
+        self._slots[psn] = item
+
+    def pop(self, psn):
+        bit = 1 << psn
+        if not self._bitmap & bit:
+            return None
+        self._bitmap ^= bit
+        self._count -= 1
+        item = self._slots[psn]
+        self._slots[psn] = None
+        return item
+
+    def clear(self):
+        self._slots = [None] * PSN_COUNT
+        self._bitmap = 0
+        self._count = 0
+
+    def _rotated(self, start):
+        return ((self._bitmap >> start) | (self._bitmap << (PSN_COUNT - start))) & _ALL_SLOTS
+
+    def psns(self, start):
+        """Yields the occupied PSNs in sequence order, beginning at ``start``."""
+        rotated = self._rotated(start)
+        while rotated:
+            low = rotated & -rotated
+            yield (start + low.bit_length() - 1) & 0xff
+            rotated ^= low
+
+    def last(self, start):
+        """Returns the occupied PSN furthest from ``start`` in sequence order."""
+        rotated = self._rotated(start)
+        if not rotated:
+            return None
+        return (start + rotated.bit_length() - 1) & 0xff
+
+    def values(self, start):
+        for psn in self.psns(start):
+            yield self._slots[psn]
+
+    def missing(self, start, end):
+        """Yields the free PSNs from ``start`` up to, but excluding, ``end``."""
+        count = (end - start) & 0xff
+        free = ~self._rotated(start) & ((1 << count) - 1)
+        while free:
+            low = free & -free
+            yield (start + low.bit_length() - 1) & 0xff
+            free ^= low
@@ -0,0 +1,43 @@
+__all__ = ["RTTEstimator"]
+
+# lower bound for the retransmission timeout in milliseconds
+MIN_RETRANSMISSION_TIMEOUT = 10
+
+
+class RTTEstimator:
+    """Smoothed round-trip time and retransmission timeout as in RFC 6298.
+
+    All values are in milliseconds, like the timeouts of the link
+    synchronization payload. The timeout is clamped to
+    ``[min_rto, max_rto]``.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, max_rto: float, min_rto: float = MIN_RETRANSMISSION_TIMEOUT):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = max_rto
+
+    def set_bounds(self, min_rto: float, max_rto: float):
+        self.min_rto = min(min_rto, max_rto)
+        self.max_rto = max_rto
+        self.rto = self._clamp(self.rto if self.srtt is not None else max_rto)
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = self._clamp(self.srtt + self.K * self.rttvar)
+
+    def backoff(self):
+        self.rto = self._clamp(self.rto * 2)
+
+    def _clamp(self, rto):
+        return min(max(rto, self.min_rto), self.max_rto)
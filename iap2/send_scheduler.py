@@ -0,0 +1,88 @@
+__all__ = ["SendScheduler"]
+
+from collections import deque
+from struct import Struct
+
+STREAM_ID_STRUCT = Struct(">H")
+
+
+class SendScheduler:
+    """Orders the packets waiting for room in the send window.
+
+    Packets of the ``priority_sessions`` are always sent first, in the order
+    they were queued. All other packets are queued per flow, a flow being a
+    session or, for the ``stream_sessions``, a single stream identified by the
+    two byte stream id in front of the payload, either as packet prefix or
+    at the start of its data. Flows are served weighted
+    round robin, a flow with weight w may send w packets per round.
+
+    Provides the ``append``/``popleft``/``len`` subset of a deque, so a plain
+    deque can be used instead for FIFO order.
+    """
+
+    def __init__(self, priority_sessions=(), stream_sessions=(), default_weight: int = 1):
+        self.priority_sessions = frozenset(priority_sessions)
+        self.stream_sessions = frozenset(stream_sessions)
+        self.default_weight = default_weight
+        self._weights = dict()
+        self._priority = deque()
+        self._flows = dict()
+        self._round = deque()
+        self._served = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def set_weight(self, session_id: int, stream_id: int = None, weight: int = 1):
+        if weight < 1:
+            raise ValueError("weight has to be at least 1")
+        self._weights[(session_id, stream_id)] = weight
+
+    def remove_weight(self, session_id: int, stream_id: int = None):
+        """Lets the flow use the default weight again."""
+        self._weights.pop((session_id, stream_id), None)
+
+    def append(self, p):
+        self._len += 1
+        session_id = p.session_id
+        if session_id in self.priority_sessions:
+            self._priority.append(p)
+            return
+        flow = (session_id, None)
+        if session_id in self.stream_sessions:
+            head = p.prefix or p.data
+            if len(head) >= 2:
+                flow = (session_id, STREAM_ID_STRUCT.unpack_from(head)[0])
+        queue = self._flows.get(flow)
+        if queue is None:
+            queue = self._flows[flow] = deque()
+            self._round.append(flow)
+        queue.append(p)
+
+    def popleft(self):
+        if self._priority:
+            self._len -= 1
+            return self._priority.popleft()
+        if not self._round:
+            raise IndexError("pop from an empty SendScheduler")
+        self._len -= 1
+        flow = self._round[0]
+        queue = self._flows[flow]
+        p = queue.popleft()
+        self._served += 1
+        if not queue:
+            del self._flows[flow]
+            self._round.popleft()
+            self._served = 0
+        elif self._served >= self._weights.get(flow, self.default_weight):
+            self._round.rotate(-1)
+            self._served = 0
+        return p
+
+    def clear(self):
+        self._priority.clear()
+        self._flows.clear()
+        self._round.clear()
+        self._served = 0
+        self._len = 0
@@ -0,0 +1,178 @@
+__all__ = ["ShardSupervisor"]
+
+import asyncio
+import inspect
+import logging
+import multiprocessing
+import os
+import socket
+from struct import Struct
+
+from iap2.connection_manager import ConnectionManager, ConnectionStats
+
+COMMAND_CONNECTION = b'C'
+COMMAND_STATS = b'S'
+COMMAND_QUIT = b'Q'
+STATS_STRUCT = Struct(">" + "Q" * len(ConnectionStats._fields))
+
+logger = logging.getLogger(__name__)
+
+
+class ShardSupervisor:
+    """Spreads connections over worker processes.
+
+    Every worker runs its own event loop with a :class:`ConnectionManager`.
+    Accepted sockets are handed to the workers in turn over a Unix socket, the
+    parent keeps no copy of them. ``on_connection`` is called in the worker
+    with every new connection and may be a coroutine function; it has to be
+    picklable, i.e. defined at module level. Workers are spawned rather than
+    forked as the parent usually has an event loop running.
+    """
+
+    def __init__(self, workers: int = None, on_connection=None, start_method: str = "spawn",
+                 **connection_kwargs):
+        self._worker_count = workers or os.cpu_count() or 1
+        self._context = multiprocessing.get_context(start_method)
+        self._on_connection = on_connection
+        self._connection_kwargs = connection_kwargs
+        self._workers = []
+        self._next_worker = 0
+        self._server_task = None
+        self._listener = None
+        self._lock = None
+
+    @property
+    def address(self):
+        return self._listener.getsockname() if self._listener else None
+
+    def start(self):
+        for _ in range(self._worker_count):
+            parent_sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = self._context.Process(target=_worker_main,
+                                             args=(worker_sock, self._on_connection, self._connection_kwargs),
+                                             daemon=True)
+            process.start()
+            worker_sock.close()
+            parent_sock.setblocking(False)
+            self._workers.append((process, parent_sock))
+
+    async def serve(self, host="127.0.0.1", port=0, backlog=128):
+        """Accepts TCP connections on ``host:port`` and passes them on to the workers."""
+        listener = socket.create_server((host, port), backlog=backlog)
+        listener.setblocking(False)
+        self._listener = listener
+        self._server_task = asyncio.create_task(self._accept_loop(listener))
+
+    def dispatch(self, sock: socket.socket):
+        """Hands a connected socket to a worker, the socket is closed in this process.
+
+        Workers whose command socket is full or gone are skipped. Raises
+        ConnectionError if no worker took the socket, it is closed anyway.
+        """
+        try:
+            for _ in range(len(self._workers)):
+                worker = self._next_worker
+                self._next_worker = (worker + 1) % len(self._workers)
+                try:
+                    socket.send_fds(self._workers[worker][1], [COMMAND_CONNECTION], [sock.fileno()])
+                    return
+                except (BlockingIOError, BrokenPipeError, ConnectionResetError) as e:
+                    logger.warning("worker %d did not take the connection: %r", worker, e)
+            raise ConnectionError("no worker took the connection")
+        finally:
+            sock.close()
+
+    async def stats(self) -> ConnectionStats:
+        """Sums up the connection stats of all workers."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            totals = [0] * len(ConnectionStats._fields)
+            for process, sock in self._workers:
+                await loop.sock_sendall(sock, COMMAND_STATS)
+                reply = await loop.sock_recv(sock, STATS_STRUCT.size)
+                if len(reply) != STATS_STRUCT.size:
+                    raise ConnectionError(f"worker {process.pid} exited")
+                for i, value in enumerate(STATS_STRUCT.unpack(reply)):
+                    totals[i] += value
+        return ConnectionStats(*totals)
+
+    async def close(self, timeout: float = 5.0):
+        if self._server_task:
+            self._server_task.cancel()
+            self._server_task = None
+        if self._listener:
+            self._listener.close()
+            self._listener = None
+        loop = asyncio.get_running_loop()
+        for process, sock in self._workers:
+            try:
+                await loop.sock_sendall(sock, COMMAND_QUIT)
+            except OSError:
+                pass
+        for process, sock in self._workers:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+            sock.close()
+        self._workers.clear()
+        self._next_worker = 0
+
+    async def _accept_loop(self, listener):
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, _address = await loop.sock_accept(listener)
+            try:
+                self.dispatch(sock)
+            except ConnectionError:
+                logger.exception("dropping connection")
+
+
+def _worker_main(sock, on_connection, connection_kwargs):
+    asyncio.run(_worker(sock, on_connection, connection_kwargs))
+
+
+async def _worker(sock, on_connection, connection_kwargs):
+    loop = asyncio.get_running_loop()
+    manager = ConnectionManager(**connection_kwargs)
+    sock.setblocking(False)
+    quit_fut = loop.create_future()
+    tasks = set()
+
+    async def connected(fd):
+        reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=fd))
+        conn = manager.connect(writer, reader)
+        if on_connection:
+            result = on_connection(conn)
+            if inspect.isawaitable(result):
+                await result
+
+    def on_command():
+        while True:
+            try:
+                command, fds, _flags, _address = socket.recv_fds(sock, 1, 1)
+            except BlockingIOError:
+                return
+            if command == COMMAND_CONNECTION:
+                task = loop.create_task(connected(fds[0]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif command == COMMAND_STATS:
+                sock.send(STATS_STRUCT.pack(*manager.stats()))
+            else:
+                for fd in fds:
+                    os.close(fd)
+                if not quit_fut.done():
+                    quit_fut.set_result(None)
+                return
+
+    loop.add_reader(sock.fileno(), on_command)
+    try:
+        await quit_fut
+    finally:
+        loop.remove_reader(sock.fileno())
+        for task in tasks:
+            task.cancel()
+        await manager.shutdown()
+        sock.close()
@@ -1,2 +1,12 @@
 import iap2.tests.test_control_session_message
 import iap2.tests.test_link_layer
+import iap2.tests.test_checksum
+import iap2.tests.test_psn_ring
+import iap2.tests.test_deadline_scheduler
+import iap2.tests.test_rtt_estimator
+import iap2.tests.test_ack_policy
+import iap2.tests.test_congestion
+import iap2.tests.test_connection_manager
+import iap2.tests.test_sharding
+import iap2.tests.test_send_scheduler
+import iap2.tests.test_ea_sessions
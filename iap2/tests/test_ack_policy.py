@@ -0,0 +1,92 @@
+import unittest
+from unittest.mock import Mock
+
+from iap2.ack_policy import ImmediateAckPolicy, DelayedAckPolicy, SessionAckPolicy
+from iap2.link_layer import IAP2Connection, STATE_NORMAL
+
+
+class TestAckPolicy(unittest.TestCase):
+    def setUp(self):
+        self.conn = IAP2Connection(input=None, output=None, max_outgoing=10)
+
+    def test_immediate(self):
+        policy = ImmediateAckPolicy()
+        self.assertTrue(policy.on_data(self.conn, 10, 1))
+        policy.on_ack(timer=False)
+        self.assertEqual(policy.saved_acks, 0)
+
+    def test_delayed(self):
+        policy = DelayedAckPolicy()
+        self.assertFalse(policy.on_data(self.conn, 11, 1))
+        self.assertFalse(policy.on_data(self.conn, 11, 2))
+        self.assertTrue(policy.on_data(self.conn, 11, 3))
+        policy.on_ack(timer=False)
+        self.assertEqual(policy.saved_acks, 2)
+
+        self.assertFalse(policy.on_data(self.conn, 11, 1))
+        self.assertFalse(policy.on_data(self.conn, 11, 2))
+        policy.on_ack(timer=True)
+        self.assertEqual(policy.saved_acks, 3)
+
+    def test_delayed_max_pending(self):
+        policy = DelayedAckPolicy(max_pending=5)
+        self.assertFalse(policy.on_data(self.conn, 11, 4))
+        self.assertTrue(policy.on_data(self.conn, 11, 5))
+
+    def test_session(self):
+        immediate = ImmediateAckPolicy()
+        delayed = DelayedAckPolicy()
+        policy = SessionAckPolicy({10: immediate}, default=delayed)
+        self.assertFalse(policy.on_data(self.conn, 11, 1))
+        self.assertTrue(policy.on_data(self.conn, 10, 2))
+        policy.on_ack(timer=False)
+        self.assertEqual(delayed.saved_acks, 1)
+        self.assertEqual(policy.saved_acks, 1)
+
+
+class TestConnectionAckPolicy(unittest.TestCase):
+    def setUp(self):
+        conn = IAP2Connection(input=None, output=None, max_outgoing=10)
+        conn.state = STATE_NORMAL
+        conn._sent_psn = 199
+        conn._last_acked_psn = 99
+        conn._last_received_in_sequence_psn = 99
+        conn._received_data = Mock()
+        conn._send_ack = Mock()
+        conn._send_data = Mock()
+        conn._rearm_send_ack_timer = Mock()
+        conn._disarm_send_ack_timer = Mock()
+        self.conn = conn
+
+    def receive(self, psn, session_id):
+        p = Mock(psn=psn, session_id=session_id)
+        self.conn._handle_data(p)
+
+    def test_control_session_immediate(self):
+        self.receive(100, IAP2Connection.CONTROL_SESSION_ID)
+        self.conn._send_ack.assert_called_once()
+        self.assertEqual(self.conn._last_acked_psn, 100)
+
+    def test_ea_session_delayed(self):
+        self.receive(100, IAP2Connection.EA_SESSION_ID)
+        self.conn._send_ack.assert_not_called()
+        self.conn._rearm_send_ack_timer.assert_called()
+
+    def test_piggyback(self):
+        self.receive(100, IAP2Connection.EA_SESSION_ID)
+        self.receive(101, IAP2Connection.EA_SESSION_ID)
+        self.conn.send_packet(Mock())
+        self.conn._send_ack.assert_not_called()
+        self.conn._disarm_send_ack_timer.assert_called()
+        self.assertEqual(self.conn._last_acked_psn, 101)
+        self.assertEqual(self.conn.ack_policy.saved_acks, 2)
+
+        self.conn.send_packet(Mock())
+        self.assertEqual(self.conn.ack_policy.saved_acks, 2)
+
+    def test_ack_timer(self):
+        self.receive(100, IAP2Connection.EA_SESSION_ID)
+        self.receive(101, IAP2Connection.EA_SESSION_ID)
+        self.conn._on_send_ack_timer()
+        self.conn._send_ack.assert_called_once()
+        self.assertEqual(self.conn.ack_policy.saved_acks, 1)
@@ -0,0 +1,41 @@
+import os
+import unittest
+from functools import reduce
+
+from iap2 import checksum
+from iap2.checksum import Checksum, gen_checksum, check_checksum
+
+
+def reference_checksum(packet):
+    return -reduce(lambda a, b: (a + b) & 0xff, packet) & 0xff
+
+
+class TestChecksum(unittest.TestCase):
+    def test_gen_checksum(self):
+        for size in [1, 9, 255, 4096, 65535]:
+            packet = os.urandom(size)
+            self.assertEqual(gen_checksum(packet), reference_checksum(packet))
+            self.assertEqual(gen_checksum(memoryview(packet)), reference_checksum(packet))
+
+    def test_check_checksum(self):
+        header_bytes = b'\xffZ\x00\x1a\x80+\x00\x00\xe2'
+        self.assertTrue(check_checksum(header_bytes))
+        self.assertFalse(check_checksum(header_bytes[:-1] + b'\xe1'))
+
+    def test_streaming(self):
+        packet = os.urandom(10000)
+        c = Checksum()
+        for i in range(0, len(packet), 777):
+            c.update(packet[i:i + 777])
+        self.assertEqual(c.digest(), gen_checksum(packet))
+        self.assertFalse(c.check())
+        self.assertTrue(c.update(bytes([c.digest()])).check())
+
+    def test_without_numpy(self):
+        packet = os.urandom(checksum.NUMPY_THRESHOLD * 2)
+        numpy = checksum.numpy
+        checksum.numpy = None
+        try:
+            self.assertEqual(gen_checksum(packet), reference_checksum(packet))
+        finally:
+            checksum.numpy = numpy
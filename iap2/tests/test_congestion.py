@@ -0,0 +1,71 @@
+import unittest
+from unittest.mock import Mock
+
+from iap2.congestion import AIMDController
+from iap2.link_layer import IAP2Connection, STATE_NORMAL
+
+
+class TestAIMDController(unittest.TestCase):
+    def test_additive_increase(self):
+        c = AIMDController(initial_window=4)
+        self.assertEqual(c.window(30), 4)
+        c.on_ack(4, 30)
+        self.assertEqual(c.window(30), 5)
+        for _ in range(100):
+            c.on_ack(1, 30)
+        self.assertEqual(c.window(30), 15)
+        self.assertEqual(c.window(8), 8)
+
+    def test_bounded_by_max_outgoing(self):
+        c = AIMDController(initial_window=4)
+        for _ in range(100):
+            c.on_ack(10, 6)
+        self.assertEqual(c.cwnd, 6)
+
+    def test_multiplicative_decrease(self):
+        c = AIMDController(initial_window=16)
+        c.on_loss(10.0, 0.1)
+        self.assertEqual(c.window(30), 8)
+        c.on_loss(10.05, 0.1)
+        self.assertEqual(c.window(30), 8)
+        c.on_loss(10.2, 0.1)
+        self.assertEqual(c.window(30), 4)
+        for i in range(5):
+            c.on_loss(11.0 + i, 0.1)
+        self.assertEqual(c.window(30), 1)
+        self.assertEqual(c.losses, 7)
+
+
+class TestConnectionCongestionControl(unittest.TestCase):
+    def setUp(self):
+        self.loop = Mock()
+        self.loop.time.return_value = 10.0
+        conn = IAP2Connection(input=None, output=None, loop=self.loop, max_outgoing=30, congestion_control=True)
+        conn.state = STATE_NORMAL
+        conn._sent_psn = 199
+        conn._last_sent_acknowledged_psn = 199
+        conn._send_data = Mock()
+        self.conn = conn
+
+    def test_window(self):
+        self.assertEqual(self.conn.send_window, 4)
+        packets = [Mock() for _ in range(10)]
+        for p in packets:
+            self.conn.send_packet(p)
+        self.assertEqual(len(self.conn._unack_packets), 4)
+        self.assertEqual(len(self.conn._queued_packets), 6)
+
+        self.conn._handle_ack(packets[3].psn)
+        self.assertEqual(self.conn.send_window, 5)
+        self.assertEqual(len(self.conn._unack_packets), 5)
+
+    def test_timeout_halves_window(self):
+        self.conn._congestion.cwnd = 20
+        p = Mock()
+        self.conn.send_packet(p)
+        self.conn._on_expect_ack_timer(p.psn)
+        self.assertEqual(self.conn.send_window, 10)
+
+    def test_disabled(self):
+        conn = IAP2Connection(input=None, output=None, max_outgoing=30)
+        self.assertEqual(conn.send_window, 30)
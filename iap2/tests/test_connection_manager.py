@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+
+from iap2.connection_manager import ConnectionManager
+from iap2.link_layer import STATE_NORMAL
+from iap2.transport.memory import memory_transport_pair
+
+
+async def wait_for(condition, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise TimeoutError()
+        await asyncio.sleep(0.01)
+
+
+class TestConnectionManager(unittest.TestCase):
+    def test_many_connections(self):
+        pairs = 500
+
+        async def run():
+            manager = ConnectionManager(max_outgoing=4)
+            connections = []
+            for _ in range(pairs):
+                a, b = memory_transport_pair()
+                connections.append((manager.connect(*a), manager.connect(*b)))
+            self.assertEqual(len(manager), 2 * pairs)
+
+            await wait_for(lambda: manager.stats().established == 2 * pairs)
+
+            for i, (a, b) in enumerate(connections):
+                a.control_session.write(b'ping %d' % i)
+                await a.control_session.drain()
+            for i, (a, b) in enumerate(connections):
+                expected = b'ping %d' % i
+                self.assertEqual(await b.control_session.readexactly(len(expected)), expected)
+            await wait_for(lambda: manager.stats().in_flight == 0)
+
+            stats = manager.stats()
+            self.assertEqual(stats.connections, 2 * pairs)
+            self.assertEqual(stats.queued, 0)
+            self.assertEqual(stats.errors, 0)
+
+            await manager.shutdown()
+            self.assertEqual(len(manager), 0)
+            self.assertEqual(manager.stats().closed, 2 * pairs)
+            self.assertTrue(all(a.state != STATE_NORMAL and b.state != STATE_NORMAL for a, b in connections))
+
+        asyncio.run(run())
+
+    def test_closed_connection_is_dropped(self):
+        async def run():
+            closed = []
+            manager = ConnectionManager(on_close=lambda: closed.append("default"))
+            a, b = memory_transport_pair()
+            conn_a = manager.connect(*a)
+            conn_b = manager.connect(*b, on_close=lambda: closed.append("b"))
+            await wait_for(lambda: manager.stats().established == 2)
+            conn_a.close()
+            await conn_a.wait_closed()
+            await conn_b.wait_closed()
+            self.assertEqual(len(manager), 0)
+            self.assertEqual(manager.closed, 2)
+            self.assertEqual(sorted(closed), ["b", "default"])
+            await manager.shutdown()
+
+        asyncio.run(run())
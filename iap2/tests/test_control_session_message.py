@@ -4,7 +4,8 @@ from typing import Annotated, List
 
 from iap2.control_session_message.identification import MatchAction, ExternalAccessoryProtocol, PowerProvidingCapability, IdentificationInformation, \
     BluetoothTransportComponent
-from iap2.control_session_message import  Uint16, register_csm, Uint8, csm,  read_csm
+from iap2.control_session_message import  Uint16, register_csm, Uint8, csm,  read_csm, parse_csm
+from iap2.control_session_message.eap import StatusExternalAccessoryProtocolSession, SessionStatus
 from iap2.tests.utils import gen_pipe
 
 
@@ -22,10 +23,10 @@ class TestControlSessionMessage(unittest.TestCase):
 
     def test_roundtrip(self):
         import asyncio
-        loop = asyncio.get_event_loop()
         register_csm(IdentificationInformation)
 
         async def test():
+            loop = asyncio.get_running_loop()
             reader, writer = await gen_pipe(loop)
             expected_csm = IdentificationInformation(
                 name="raspberrypi",
@@ -63,4 +64,11 @@ class TestControlSessionMessage(unittest.TestCase):
             print(actual_csm)
             self.assertEqual(expected_csm, actual_csm)
 
-        loop.run_until_complete(test())
+        asyncio.run(test())
+
+    def test_parse(self):
+        register_csm(StatusExternalAccessoryProtocolSession)
+        expected_csm = StatusExternalAccessoryProtocolSession(session_id=Uint16(3), status=SessionStatus.CLOSE)
+        data = memoryview(expected_csm.csm_serialize())
+        self.assertEqual(parse_csm(data), expected_csm)
+        self.assertIsNone(parse_csm(data[:-1]))
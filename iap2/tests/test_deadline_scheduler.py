@@ -0,0 +1,90 @@
+import unittest
+from unittest.mock import Mock
+
+from iap2.deadline_scheduler import DeadlineScheduler
+
+
+class FakeLoop:
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = Mock()
+        handle.when = when
+        handle.callback = callback
+        self.handles.append(handle)
+        return handle
+
+    def advance(self, when):
+        self.now = when
+        handle = self.handles[-1]
+        handle.cancel.assert_not_called()
+        handle.callback()
+
+
+class TestDeadlineScheduler(unittest.TestCase):
+    def test_single_armed_timer(self):
+        loop = FakeLoop()
+        timers = DeadlineScheduler(loop)
+        callback = Mock()
+        timers.schedule("a", 1.0, callback, "a")
+        timers.schedule("b", 2.0, callback, "b")
+        timers.schedule("a", 3.0, callback, "a")
+        self.assertEqual(len(loop.handles), 1)
+        self.assertEqual(timers.next_deadline(), 2.0)
+
+        loop.advance(1.0)
+        callback.assert_not_called()
+        loop.advance(2.0)
+        callback.assert_called_once_with("b")
+        loop.advance(3.0)
+        callback.assert_called_with("a")
+        self.assertEqual(len(timers), 0)
+        self.assertIsNone(timers.next_deadline())
+
+    def test_earlier_deadline_rearms(self):
+        loop = FakeLoop()
+        timers = DeadlineScheduler(loop)
+        callback = Mock()
+        timers.schedule("a", 2.0, callback)
+        timers.schedule("b", 1.0, callback)
+        self.assertEqual(len(loop.handles), 2)
+        loop.handles[0].cancel.assert_called()
+        self.assertEqual(loop.handles[1].when, 1.0)
+
+    def test_cancel(self):
+        loop = FakeLoop()
+        timers = DeadlineScheduler(loop)
+        callback = Mock()
+        timers.schedule("a", 1.0, callback)
+        timers.cancel("a")
+        self.assertNotIn("a", timers)
+        loop.advance(1.0)
+        callback.assert_not_called()
+
+    def test_compaction(self):
+        loop = FakeLoop()
+        timers = DeadlineScheduler(loop)
+        callback = Mock()
+        for i in range(1000):
+            timers.schedule("ack", 1.0 + i, callback)
+        self.assertLess(len(timers._heap), 200)
+        self.assertEqual(timers.deadline("ack"), 1000.0)
+
+    def test_without_loop(self):
+        timers = DeadlineScheduler()
+        callback = Mock()
+        timers.schedule("a", 1.0, callback, "a")
+        timers.schedule("b", 2.0, callback, "b")
+        timers.run_due(0.5)
+        callback.assert_not_called()
+        timers.run_due(1.5)
+        callback.assert_called_once_with("a")
+        self.assertEqual(timers.next_deadline(), 2.0)
+        timers.run_due(2.0)
+        callback.assert_called_with("b")
+        self.assertIsNone(timers.next_deadline())
@@ -0,0 +1,139 @@
+import asyncio
+import unittest
+
+from iap2.control_session_message import read_csm, write_csm, register_csm, Uint8, Uint16
+from iap2.control_session_message.eap import StartExternalAccessoryProtocolSession, \
+    StopExternalAccessoryProtocolSession, StatusExternalAccessoryProtocolSession, SessionStatus
+from iap2.ea_sessions import EASessionManager
+from iap2.link_layer import IAP2Connection, STATE_NORMAL
+from iap2.tests.test_connection_manager import wait_for
+from iap2.tests.test_link_layer import async_test
+from iap2.transport.memory import memory_transport_pair
+
+
+class TestEASessionManager(unittest.TestCase):
+    async def setup(self):
+        a, b = memory_transport_pair()
+        self.accessory = IAP2Connection(*a)
+        self.device = IAP2Connection(*b)
+        self.accessory.start()
+        self.device.start()
+        await wait_for(lambda: self.accessory.state == STATE_NORMAL and self.device.state == STATE_NORMAL)
+        self.manager = EASessionManager(self.accessory)
+        self.control_task = asyncio.ensure_future(self.read_control())
+        register_csm(StatusExternalAccessoryProtocolSession)
+
+    async def teardown(self):
+        self.control_task.cancel()
+        await self.manager.close()
+        self.accessory.abort()
+        self.device.abort()
+
+    async def read_control(self):
+        while True:
+            message = await read_csm(self.accessory.control_session)
+            self.assertTrue(self.manager.handle_csm(message))
+
+    async def start_session(self, protocol_id, session_id):
+        await write_csm(self.device.control_session,
+                        StartExternalAccessoryProtocolSession(protocol_id=Uint8(protocol_id),
+                                                              session_id=Uint16(session_id)))
+
+    @async_test
+    async def test_echo_sessions(self):
+        await self.setup()
+
+        async def echo(stream):
+            async for chunk in stream:
+                stream.write(bytes(chunk))
+                await stream.drain()
+
+        self.manager.register_protocol(1, echo)
+        sessions = range(100, 140)
+        for session_id in sessions:
+            await self.start_session(1, session_id)
+        await wait_for(lambda: len(self.manager) == len(sessions))
+
+        device_streams = {session_id: self.device.create_ea_stream(session_id) for session_id in sessions}
+        for session_id, stream in device_streams.items():
+            stream.write(b'hello %d' % session_id)
+            await stream.drain()
+        for session_id, stream in device_streams.items():
+            expected = b'hello %d' % session_id
+            self.assertEqual(await asyncio.wait_for(stream.readexactly(len(expected)), 1), expected)
+
+        await write_csm(self.device.control_session, StopExternalAccessoryProtocolSession(session_id=Uint16(100)))
+        await wait_for(lambda: 100 not in self.manager)
+        self.assertNotIn(100, self.accessory.ea_streams)
+        self.assertEqual(len(self.manager), len(sessions) - 1)
+        await self.teardown()
+        self.assertEqual(len(self.manager), 0)
+        self.assertEqual(self.accessory.ea_streams, {})
+
+    @async_test
+    async def test_handler_returns(self):
+        await self.setup()
+
+        async def greet(stream):
+            stream.write(b'bye')
+            await stream.drain()
+
+        self.manager.register_protocol(2, greet)
+        device_stream = self.device.create_ea_stream(7)
+        await self.start_session(2, 7)
+        self.assertEqual(await asyncio.wait_for(device_stream.readexactly(3), 1), b'bye')
+        status = await asyncio.wait_for(read_csm(self.device.control_session), 1)
+        self.assertEqual(status, StatusExternalAccessoryProtocolSession(session_id=7, status=SessionStatus.CLOSE))
+        self.assertNotIn(7, self.manager)
+        await self.teardown()
+
+    @async_test
+    async def test_data_right_after_start(self):
+        await self.setup()
+        received = asyncio.get_running_loop().create_future()
+
+        async def read(stream):
+            received.set_result(await stream.readexactly(5))
+
+        self.manager.register_protocol(1, read)
+        self.control_task.cancel()
+        device_stream = self.device.create_ea_stream(5)
+        await self.start_session(1, 5)
+        device_stream.write(b'hello')
+        await device_stream.drain()
+        await wait_for(lambda: 5 in self.accessory._pending_ea)
+        self.control_task = asyncio.ensure_future(self.read_control())
+        self.assertEqual(await asyncio.wait_for(received, 1), b'hello')
+        self.assertEqual(self.accessory._pending_ea_size, 0)
+        await self.teardown()
+
+    @async_test
+    async def test_stop_drops_pending_data(self):
+        await self.setup()
+        self.control_task.cancel()
+        device_stream = self.device.create_ea_stream(6)
+        await self.start_session(9, 6)
+        device_stream.write(b'lost')
+        await device_stream.drain()
+        await wait_for(lambda: 6 in self.accessory._pending_ea)
+        self.control_task = asyncio.ensure_future(self.read_control())
+        await asyncio.wait_for(read_csm(self.device.control_session), 1)
+        self.assertEqual(self.accessory._pending_ea, {})
+        self.assertEqual(self.accessory._pending_ea_size, 0)
+        await self.teardown()
+
+    @async_test
+    async def test_unknown_protocol(self):
+        await self.setup()
+        await self.start_session(9, 3)
+        status = await asyncio.wait_for(read_csm(self.device.control_session), 1)
+        self.assertEqual(status, StatusExternalAccessoryProtocolSession(session_id=3, status=SessionStatus.CLOSE))
+        self.assertEqual(len(self.manager), 0)
+        self.assertNotIn(3, self.accessory.ea_streams)
+        await self.teardown()
+
+    def test_other_messages(self):
+        manager = EASessionManager(IAP2Connection(input=None, output=None))
+        self.assertFalse(manager.handle_csm(None))
+        self.assertFalse(manager.handle_csm(StatusExternalAccessoryProtocolSession(session_id=1,
+                                                                                   status=SessionStatus.OK)))
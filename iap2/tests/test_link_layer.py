@@ -1,11 +1,15 @@
 import asyncio
 import unittest
-from unittest.mock import Mock, call
+from unittest.mock import Mock, call, patch
+import mmap
 import random
+import tempfile
 
 from iap2.link_layer import CONTROL_SYN, CONTROL_ACK, LinkSynchronizationPayload, LinkPacketHeader, IAP2_MARKER, \
-    STATE_NORMAL, gen_checksum, IAP2Connection, LSPSession
+    STATE_NORMAL, STATE_DEAD, gen_checksum, IAP2Packet, IAP2Connection, IAP2Link, LSPSession, LinkFrameDecoder, LinkHints, \
+    TRANSPORT_LINK_HINTS, CONTROL_EAK, signed_add
 from iap2.tests.utils import gen_pipe
+from iap2.transport.memory import memory_transport_pair
 
 
 class TestLinkPacketHeader(unittest.TestCase):
@@ -22,6 +26,12 @@ class TestLinkPacketHeader(unittest.TestCase):
         repacked_header_bytes = header.pack()
         self.assertEqual(repacked_header_bytes, header_bytes)
 
+    def test_slots(self):
+        header = LinkPacketHeader(length=9, control=0, seq=1, ack=2, session_id=0)
+        self.assertFalse(hasattr(header, "__dict__"))
+        p = IAP2Packet(b'abc', session_id=10)
+        self.assertFalse(hasattr(p, "__dict__"))
+
     def test_invalid_check(self):
         header_bytes = b'\xffZ\x00\x1a\x80+\x00\x00\xe1'
         header = LinkPacketHeader.from_bytes(header_bytes)
@@ -33,6 +43,62 @@ class TestLinkPacketHeader(unittest.TestCase):
         self.assertIsNone(header)
 
 
+class TestLinkFrameDecoder(unittest.TestCase):
+    @staticmethod
+    def frame(payload=None, seq=1, session_id=10):
+        header = LinkPacketHeader(length=10 + len(payload) if payload else 9,
+                                  control=CONTROL_ACK,
+                                  seq=seq,
+                                  ack=0,
+                                  session_id=session_id)
+        if not payload:
+            return header.pack()
+        return header.pack() + payload + bytes([gen_checksum(payload)])
+
+    def test_multiple_frames(self):
+        decoder = LinkFrameDecoder()
+        decoder.feed(self.frame(b'abc', seq=1) + self.frame(seq=2) + self.frame(b'de', seq=3))
+        frames = list(decoder)
+        self.assertEqual([(h.seq, p) for h, p in frames], [(1, b'abc'), (2, None), (3, b'de')])
+        self.assertEqual(len(decoder), 0)
+
+    def test_split_frame(self):
+        decoder = LinkFrameDecoder()
+        frame = self.frame(b'hello world')
+        for b in frame[:-1]:
+            decoder.feed(bytes([b]))
+            self.assertEqual(list(decoder), [])
+        decoder.feed(frame[-1:])
+        [(header, payload)] = list(decoder)
+        self.assertEqual(payload, b'hello world')
+
+    def test_resync(self):
+        decoder = LinkFrameDecoder()
+        decoder.feed(b'\x30\xff\x00\xff' + self.frame(b'abc'))
+        decoder.feed(b'\x00' * 100 + b'\xff')
+        self.assertEqual([p for _, p in decoder], [b'abc'])
+        self.assertEqual(len(decoder), 1)
+        decoder.feed(self.frame(b'x')[1:])
+        self.assertEqual([p for _, p in decoder], [b'x'])
+
+    def test_reuse_header(self):
+        decoder = LinkFrameDecoder(reuse_header=True)
+        decoder.feed(self.frame(b'abc', seq=1) + self.frame(b'de', seq=2))
+        headers = []
+        for header, payload in decoder:
+            headers.append(header)
+            self.assertEqual(header.length, 10 + len(payload))
+        self.assertIs(headers[0], headers[1])
+        self.assertEqual(headers[1].seq, 2)
+
+    def test_invalid_checksum(self):
+        decoder = LinkFrameDecoder()
+        broken = bytearray(self.frame(b'abc', seq=1))
+        broken[-1] ^= 1
+        decoder.feed(bytes(broken) + self.frame(b'def', seq=2))
+        self.assertEqual([(h.seq, p) for h, p in decoder], [(2, b'def')])
+
+
 class TestLinkSynchronizationPayload(unittest.TestCase):
     def test_round_trip(self):
         payload = b'\x01\x05\x10\x00\x04\x0B\x00\x17\x03\x03\x0A\x00\x01\x0B\x02\x01'
@@ -54,10 +120,38 @@ class TestLinkSynchronizationPayload(unittest.TestCase):
         self.assertEqual(repacked_payload, payload)
 
 
+class TestLinkHints(unittest.TestCase):
+    def test_default(self):
+        conn = IAP2Connection(input=None, output=None)
+        default = TRANSPORT_LINK_HINTS["default"]
+        self.assertEqual(conn.lsp.max_len, default.max_len)
+        self.assertEqual(conn.lsp.retransmission_timeout, default.retransmission_timeout)
+        self.assertEqual(conn.lsp.ack_timeout, default.ack_timeout)
+        self.assertEqual(conn.lsp.max_outgoing, default.max_outgoing)
+
+    def test_transport_hints(self):
+        input = Mock(link_hints=LinkHints(max_len=630, retransmission_timeout=800, ack_timeout=20, max_outgoing=6))
+        output = Mock(link_hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        conn = IAP2Connection(input=input, output=output)
+        self.assertEqual(conn.lsp.max_len, 630)
+        self.assertEqual(conn.lsp.retransmission_timeout, 800)
+        self.assertEqual(conn.lsp.ack_timeout, 20)
+        self.assertEqual(conn.lsp.max_outgoing, 6)
+        self.assertEqual(conn.rto, 800)
+
+    def test_explicit(self):
+        conn = IAP2Connection(input=None, output=Mock(link_hints=TRANSPORT_LINK_HINTS["usb_hid"]),
+                              hints=TRANSPORT_LINK_HINTS["bluetooth"], max_outgoing=3, ack_timeout=42)
+        self.assertEqual(conn.lsp.max_len, TRANSPORT_LINK_HINTS["bluetooth"].max_len)
+        self.assertEqual(conn.lsp.max_outgoing, 3)
+        self.assertEqual(conn.lsp.ack_timeout, 42)
+
+
 class TestIAP2Connection(unittest.TestCase):
     class TestPacket:
-        def __init__(self):
+        def __init__(self, session_id=None):
             self.id = random.random()
+            self.session_id = session_id
 
     def test_normal(self):
         conn = IAP2Connection(input=None, output=None, max_outgoing=3)
@@ -88,7 +182,7 @@ class TestIAP2Connection(unittest.TestCase):
         conn._disarm_send_ack_timer.assert_called()
         conn._rearm_recv_ack_timer.assert_called()
         self.assertEqual(p2.psn, 200)
-        self.assertEqual(conn._unack_packets, [p2])
+        self.assertEqual(list(conn._unack_packets.values(p2.psn)), [p2])
 
         p3 = TestIAP2Connection.TestPacket()
         p3.psn = 101
@@ -103,7 +197,7 @@ class TestIAP2Connection(unittest.TestCase):
         conn._handle_ack(200)
 
         conn._disarm_recv_ack_timer.assert_called()
-        self.assertEqual(conn._unack_packets, [])
+        self.assertEqual(len(conn._unack_packets), 0)
 
         p4 = TestIAP2Connection.TestPacket()
         p4.psn = 102
@@ -147,28 +241,61 @@ class TestIAP2Connection(unittest.TestCase):
         conn._send_data.assert_called_with(p2)
         conn._rearm_recv_ack_timer.assert_called()
 
-        conn._on_expect_ack_timer()
+        conn._on_expect_ack_timer(p1.psn)
         conn._send_data.assert_called_with(p1)
 
-        conn._rearm_recv_ack_timer.assert_called()
-        conn._on_expect_ack_timer()
+        conn._rearm_recv_ack_timer.assert_called_with(p1)
+        conn._on_expect_ack_timer(p2.psn)
         conn._send_data.assert_called_with(p2)
 
         conn._handle_ack(p1.psn)
-        self.assertEqual(conn._unack_packets, [p2])
+        self.assertEqual(list(conn._unack_packets.values(p2.psn)), [p2])
 
-        conn._on_expect_ack_timer()
+        conn._on_expect_ack_timer(p2.psn)
         conn._send_data.assert_called_with(p2)
 
         conn._handle_ack(p2.psn)
 
-        conn._disarm_recv_ack_timer.asser_called()
+        conn._disarm_recv_ack_timer.assert_called_with(p2.psn)
+
+    def test_rtt_sample(self):
+        loop = Mock()
+        loop.time.return_value = 10.0
+        conn = IAP2Connection(input=None, output=None, loop=loop, max_outgoing=3)
+        conn.state = STATE_NORMAL
+        conn._sent_psn = 199
+        conn._send_data = Mock()
+        self.assertIsNone(conn.rtt)
+        self.assertEqual(conn.rto, 4000)
+
+        p1 = TestIAP2Connection.TestPacket()
+        conn.send_packet(p1)
+        p2 = TestIAP2Connection.TestPacket()
+        conn.send_packet(p2)
+        self.assertEqual(p1.timeout, 14.0)
+
+        loop.time.return_value = 10.02
+        conn._on_expect_ack_timer(p2.psn)
+        self.assertEqual(conn.rto, 4000)
+        conn._handle_ack(p2.psn)
+        self.assertIsNone(conn.rtt)
+
+        p3 = TestIAP2Connection.TestPacket()
+        conn.send_packet(p3)
+        loop.time.return_value = 10.04
+        conn._handle_ack(p3.psn)
+        self.assertAlmostEqual(conn.rtt, 20)
+        self.assertAlmostEqual(conn.rto, 60)
+
+        p4 = TestIAP2Connection.TestPacket()
+        conn.send_packet(p4)
+        self.assertAlmostEqual(p4.timeout, 10.1)
 
     def test_buffer(self):
         conn = IAP2Connection(input=None, output=None, max_outgoing=2)
         conn.state = STATE_NORMAL
         conn._sent_psn = 199
-        conn._last_sent_acknowledged_psn = 198
+        conn._last_sent_acknowledged_psn = 199
         conn._rearm_recv_ack_timer = Mock()
         conn._disarm_send_ack_timer = Mock()
         conn._disarm_recv_ack_timer = Mock()
@@ -238,14 +365,19 @@ class TestIAP2Connection(unittest.TestCase):
 
         p2 = TestIAP2Connection.TestPacket()
         p2.psn = 107
+        conn._send_eak = Mock()
 
         conn._handle_data(p2)
 
+        conn._send_eak.assert_called_once_with([104, 105, 106])
+
         p3 = TestIAP2Connection.TestPacket()
         p3.psn = 105
 
         conn._handle_data(p3)
 
+        conn._send_eak.assert_called_once()
+
         p4 = TestIAP2Connection.TestPacket()
         p4.psn = 104
         conn._disarm_send_ack_timer = Mock()
@@ -275,20 +407,26 @@ class TestIAP2Connection(unittest.TestCase):
 
         p2 = TestIAP2Connection.TestPacket()
         p2.psn = 0
+        conn._send_eak = Mock()
 
         conn._handle_data(p2)
 
+        conn._send_eak.assert_called_once_with([255])
+        # the EAK carries the ACK of 254
+        self.assertEqual(conn._last_acked_psn, 254)
+
         p3 = TestIAP2Connection.TestPacket()
         p3.psn = 255
-        conn._disarm_send_ack_timer = Mock()
+        conn._rearm_send_ack_timer.reset_mock()
         conn._send_ack = Mock()
 
         conn._handle_data(p3)
 
         conn._received_data.assert_has_calls([call(p3), call(p2)])
-        conn._send_ack.assert_called()
         self.assertEqual(conn._last_received_in_sequence_psn, p2.psn)
-        conn._disarm_send_ack_timer.assert_called()
+        # two packets pending with a window of three, the ACK is delayed
+        conn._send_ack.assert_not_called()
+        conn._rearm_send_ack_timer.assert_called()
 
     def test_eak(self):
         conn = IAP2Connection(input=None, output=None, max_outgoing=2)
@@ -347,20 +485,746 @@ class TestIAP2Connection(unittest.TestCase):
         self.assertEqual(conn._last_received_in_sequence_psn, p1.psn)
 
 
+class TestFastRetransmit(unittest.TestCase):
+    def setUp(self):
+        self.loop = Mock()
+        self.loop.time.return_value = 10.0
+        conn = IAP2Connection(input=None, output=None, loop=self.loop, max_outgoing=10)
+        conn.state = STATE_NORMAL
+        conn._sent_psn = 199
+        conn._last_sent_acknowledged_psn = 199
+        conn._send_data = Mock()
+        self.conn = conn
+        self.packets = []
+        for _ in range(4):
+            p = TestIAP2Connection.TestPacket()
+            conn.send_packet(p)
+            self.packets.append(p)
+        conn._send_data.reset_mock()
+
+    def test_eak(self):
+        p1, p2, p3, p4 = self.packets
+        self.conn._handle_eak([p2.psn, p4.psn])
+        self.conn._send_data.assert_has_calls([call(p2), call(p4)])
+        self.assertEqual(p2.timeout, 10.0 + self.conn.rto / 1000)
+        self.conn._send_data.reset_mock()
+
+        self.loop.time.return_value = 10.5
+        self.conn._handle_eak([p2.psn])
+        self.conn._send_data.assert_not_called()
+
+    def test_not_counted_as_timeout(self):
+        p1 = self.packets[0]
+        for i in range(self.conn.lsp.max_retransmissions + 1):
+            self.loop.time.return_value = 10.0 + 5 * i
+            self.conn._handle_eak([p1.psn])
+        self.assertEqual(p1.fast_retransmits, self.conn.lsp.max_retransmissions + 1)
+        self.assertEqual(p1.counter, 0)
+        self.assertNotEqual(self.conn.state, STATE_DEAD)
+
+    def test_duplicate_acks(self):
+        p1, p2, p3, p4 = self.packets
+        self.conn._handle_ack(p1.psn, pure_ack=True)
+        self.conn._handle_ack(p1.psn, pure_ack=False)
+        self.conn._handle_ack(p1.psn, pure_ack=True)
+        self.conn._send_data.assert_not_called()
+        self.conn._handle_ack(p1.psn, pure_ack=True)
+        self.conn._send_data.assert_called_once_with(p2)
+        self.conn._handle_ack(p1.psn, pure_ack=True)
+        self.conn._send_data.assert_called_once_with(p2)
+
+        self.assertEqual(self.conn.rtt, 0)
+        self.loop.time.return_value = 10.1
+        self.conn._handle_ack(p2.psn, pure_ack=True)
+        self.assertEqual(self.conn.rtt, 0)
+
+
+class TestEagerEak(unittest.TestCase):
+    def setUp(self):
+        self.loop = Mock()
+        self.loop.time.return_value = 10.0
+        conn = IAP2Connection(input=None, output=None, loop=self.loop, max_outgoing=10, ack_timeout=50)
+        conn.state = STATE_NORMAL
+        conn._last_acked_psn = 99
+        conn._last_received_in_sequence_psn = 99
+        conn._received_data = Mock()
+        conn._send_eak = Mock()
+        conn._send_ack = Mock()
+        self.conn = conn
+
+    def receive(self, psn):
+        p = TestIAP2Connection.TestPacket()
+        p.psn = psn
+        self.conn._handle_data(p)
+        return p
+
+    def test_first_gap(self):
+        self.receive(101)
+        self.conn._send_eak.assert_called_once_with([100])
+
+    def test_rate_limit(self):
+        self.receive(102)
+        self.conn._send_eak.assert_called_once_with([100, 101])
+        self.receive(103)
+        self.conn._send_eak.assert_called_once()
+        self.receive(105)
+        self.conn._send_eak.assert_called_with([100, 101, 104])
+        self.conn._send_eak.reset_mock()
+
+        self.receive(106)
+        self.conn._send_eak.assert_not_called()
+        self.loop.time.return_value = 10.05
+        self.receive(107)
+        self.conn._send_eak.assert_called_once_with([100, 101, 104])
+
+    def test_partial_fill(self):
+        self.receive(101)
+        self.receive(103)
+        self.conn._send_eak.reset_mock()
+        self.loop.time.return_value = 11
+        p = self.receive(100)
+        self.conn._received_data.assert_has_calls([call(p)])
+        self.assertEqual(self.conn._last_received_in_sequence_psn, 101)
+        self.conn._send_eak.assert_called_once_with([102])
+
+
+class TestCorkedWrites(unittest.TestCase):
+    def setUp(self):
+        self.loop = Mock()
+        self.loop.time.return_value = 10.0
+        self.output = Mock(spec=["write", "writelines", "close"])
+        conn = IAP2Connection(input=None, output=self.output, loop=self.loop, max_outgoing=10)
+        conn.state = STATE_NORMAL
+        conn._sent_psn = 199
+        conn._last_received_in_sequence_psn = 99
+        self.conn = conn
+
+    def flush(self):
+        self.loop.call_soon.assert_called_once()
+        self.loop.call_soon.call_args[0][0]()
+        self.loop.call_soon.reset_mock()
+
+    def test_single_transport_write(self):
+        payload = b'hello'
+        p1 = IAP2Packet(payload, session_id=10)
+        self.conn.send_packet(p1)
+        self.conn.send_packet(IAP2Packet(b'world', session_id=10))
+        self.conn._send_ack()
+        self.output.writelines.assert_not_called()
+        self.flush()
+
+        self.output.writelines.assert_called_once()
+        buffers = self.output.writelines.call_args[0][0]
+        self.assertIs(buffers[1], payload)
+        frames = b''.join(buffers)
+        decoder = LinkFrameDecoder()
+        decoder.feed(frames)
+        self.assertEqual([(h.seq, p) for h, p in decoder], [(200, b'hello'), (201, b'world'), (201, None)])
+
+    def test_retransmission_reuses_checksum(self):
+        p1 = IAP2Packet(b'hello', session_id=10)
+        self.conn.send_packet(p1)
+        self.flush()
+        self.assertEqual(p1.checksum, gen_checksum(b'hello'))
+        p1.checksum = 0x42
+        self.conn._on_expect_ack_timer(p1.psn)
+        self.flush()
+        self.assertEqual(self.output.writelines.call_args[0][0][-1], b'\x42')
+
+    def test_without_writelines(self):
+        output = Mock(spec=["write", "close"])
+        self.conn._output = output
+        self.conn._send_ack()
+        self.conn._send_ack()
+        # one message per link packet, e.g. for HID
+        self.loop.call_soon.assert_not_called()
+        self.assertEqual([len(c[0][0]) for c in output.write.call_args_list], [9, 9])
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        conn = IAP2Connection(input=None, output=None, max_outgoing=30)
+        conn.state = STATE_NORMAL
+        conn._last_acked_psn = 99
+        conn._last_received_in_sequence_psn = 99
+        conn._received_data = Mock()
+        conn._send_ack = Mock()
+        conn._send_eak = Mock()
+        self.conn = conn
+
+    @staticmethod
+    def packet(psn, session_id=IAP2Connection.CONTROL_SESSION_ID):
+        return LinkPacketHeader(length=11, control=CONTROL_ACK, seq=psn, ack=99, session_id=session_id), b'x'
+
+    def test_single_ack(self):
+        self.conn._handle_packets([self.packet(100 + i) for i in range(20)])
+        self.assertEqual(self.conn._received_data.call_count, 20)
+        self.conn._send_ack.assert_called_once()
+        self.assertEqual(self.conn._last_acked_psn, 119)
+        self.assertEqual(self.conn.batch_size_histogram, {20: 1})
+
+        self.conn._handle_packets([self.packet(120)])
+        self.assertEqual(self.conn._send_ack.call_count, 2)
+        self.assertEqual(self.conn.batch_size_histogram, {20: 1, 1: 1})
+
+    def test_single_eak(self):
+        del self.conn._send_eak
+        self.conn._write_packet = Mock()
+        self.conn._handle_packets([self.packet(psn) for psn in [100, 102, 104, 101]])
+        # the EAK carries the cumulative ACK, no separate ACK is needed
+        self.conn._write_packet.assert_called_once_with(bytes([103]), seq=self.conn._sent_psn,
+                                                        control=CONTROL_ACK | CONTROL_EAK)
+        self.conn._send_ack.assert_not_called()
+        self.assertEqual(self.conn._last_acked_psn, 102)
+
+    def test_duplicates(self):
+        self.conn._handle_packets([self.packet(99), self.packet(99)])
+        self.conn._send_ack.assert_called_once()
+
+
+class TestIAP2Link(unittest.TestCase):
+    def setUp(self):
+        self.a = IAP2Link(max_outgoing=4)
+        self.b = IAP2Link(max_outgoing=4)
+
+    def exchange(self, now, drop_a=False):
+        while True:
+            to_b = b''.join(self.a.data_to_send())
+            to_a = b''.join(self.b.data_to_send())
+            if not to_a and not to_b:
+                return
+            if not drop_a:
+                self.b.receive_data(to_b, now)
+            self.a.receive_data(to_a, now)
+
+    def connect(self):
+        self.a.start(0.0)
+        self.b.start(0.0)
+        self.exchange(0.0)
+        self.assertEqual(self.a.state, STATE_NORMAL)
+        self.assertEqual(self.b.state, STATE_NORMAL)
+        self.assertTrue(self.a.write_allowed)
+
+    def test_detect_and_negotiate(self):
+        self.a.start(0.0)
+        self.assertEqual(self.a.data_to_send(), [IAP2_MARKER])
+        self.assertEqual(self.a.next_deadline(), 1.0)
+        self.a.handle_timers(1.0)
+        self.assertEqual(self.a.data_to_send(), [IAP2_MARKER])
+        # the marker may arrive split up
+        self.a.receive_data(IAP2_MARKER[:2], 1.1)
+        self.a.receive_data(IAP2_MARKER[2:], 1.2)
+        header = LinkPacketHeader.from_bytes(b''.join(self.a.data_to_send()))
+        self.assertEqual(header.control, CONTROL_SYN)
+        self.assertEqual(self.a.next_deadline(), 1.7)
+
+    def test_not_supported(self):
+        self.a.start(0.0)
+        self.a.receive_data(b'\x00' * 6, 0.0)
+        self.assertEqual(self.a.state, STATE_DEAD)
+        self.assertEqual(self.a.error, "IAP2 not supported")
+        self.assertIsNone(self.a.next_deadline())
+
+    def test_deliver(self):
+        self.connect()
+        self.a.send_packet(IAP2Packet(b'hello', session_id=IAP2Link.CONTROL_SESSION_ID), 0.1)
+        self.exchange(0.1)
+        self.assertEqual(self.b.received_payloads(), [(IAP2Link.CONTROL_SESSION_ID, b'hello')])
+        self.assertEqual(len(self.a._unack_packets), 0)
+        self.assertEqual(self.b.received_payloads(), [])
+
+    def test_hold_receive(self):
+        self.connect()
+        room = [False]
+        self.b._can_deliver = lambda p: room[0]
+        for payload in (b'one', b'two'):
+            self.a.send_packet(IAP2Packet(payload, session_id=IAP2Link.CONTROL_SESSION_ID), 0.1)
+        self.exchange(0.1)
+        self.assertEqual(self.b.received_payloads(), [])
+        self.assertEqual(len(self.a._unack_packets), 2)
+        self.b.resume_receiving(0.2)
+        self.assertEqual(self.b.received_payloads(), [])
+        room[0] = True
+        self.b.resume_receiving(0.2)
+        self.exchange(0.2)
+        self.assertEqual(self.b.received_payloads(), [(IAP2Link.CONTROL_SESSION_ID, b'one'),
+                                                      (IAP2Link.CONTROL_SESSION_ID, b'two')])
+        self.assertEqual(len(self.a._unack_packets), 0)
+
+    def test_hold_receive_keeps_link(self):
+        self.connect()
+        self.b._can_deliver = lambda p: False
+        self.a.send_packet(IAP2Packet(b'stuck', session_id=IAP2Link.CONTROL_SESSION_ID), 0.1)
+        self.exchange(0.1)
+        while len(self.a._unack_packets):
+            now = self.a.next_deadline()
+            self.a.handle_timers(now)
+            self.exchange(now)
+        self.assertEqual(self.a.state, STATE_NORMAL)
+        self.assertEqual(self.b.received_payloads(), [(IAP2Link.CONTROL_SESSION_ID, b'stuck')])
+        self.assertGreater(self.a.retransmissions, 0)
+
+    def test_eak_acknowledges(self):
+        self.connect()
+        for n in range(5):
+            self.a.send_packet(IAP2Packet(b'%d' % n, session_id=IAP2Link.CONTROL_SESSION_ID), 0.1)
+        packets = self.a.data_to_send()
+        # header, payload and checksum of every packet, the third one is lost
+        del packets[6:9]
+        self.b.receive_data(b''.join(packets), 0.1)
+        self.a.receive_data(b''.join(self.b.data_to_send()), 0.1)
+        first = signed_add(self.a._sent_psn, -4)
+        self.assertEqual(self.a._last_sent_acknowledged_psn, signed_add(first, 1))
+        self.assertNotIn(first, self.a._unack_packets)
+        self.exchange(0.1)
+        self.assertEqual([payload for _session, payload in self.b.received_payloads()],
+                         [b'0', b'1', b'2', b'3', b'4'])
+        self.assertEqual(len(self.a._unack_packets), 0)
+
+    def test_retransmission(self):
+        self.connect()
+        self.a.send_packet(IAP2Packet(b'hello', session_id=IAP2Link.CONTROL_SESSION_ID), 0.1)
+        self.exchange(0.1, drop_a=True)
+        deadline = self.a.next_deadline()
+        self.assertAlmostEqual(deadline, 0.1 + self.a.rto / 1000)
+        self.a.handle_timers(deadline - 0.01)
+        self.assertEqual(self.a.data_to_send(), [])
+        self.a.handle_timers(deadline)
+        self.exchange(deadline)
+        self.assertEqual(self.b.received_payloads(), [(IAP2Link.CONTROL_SESSION_ID, b'hello')])
+        self.assertEqual(len(self.a._unack_packets), 0)
+
+    def test_control_before_queued_ea(self):
+        self.connect()
+        for n in range(40):
+            self.a.send_packet(IAP2Packet(bytes([0, 1, n]), session_id=IAP2Link.EA_SESSION_ID), 0.1)
+        self.a.send_packet(IAP2Packet(b'auth', session_id=IAP2Link.CONTROL_SESSION_ID), 0.1)
+        self.exchange(0.1)
+        received = self.b.received_payloads()
+        self.assertEqual(len(received), 41)
+        self.assertEqual(received[-1], (IAP2Link.EA_SESSION_ID, bytes([0, 1, 39])))
+        # only the packets already in flight get ahead of it
+        self.assertLessEqual(received.index((IAP2Link.CONTROL_SESSION_ID, b'auth')), self.a.lsp.max_outgoing + 1)
+
+    def test_max_retransmissions(self):
+        self.connect()
+        p = IAP2Packet(b'hello', session_id=IAP2Link.CONTROL_SESSION_ID)
+        self.a.send_packet(p, 0.1)
+        while self.a.state != STATE_DEAD:
+            self.a.handle_timers(self.a.next_deadline())
+        self.assertIs(self.a.error, p)
+        self.assertEqual(p.counter, self.a.lsp.max_retransmissions)
+
+
 def async_test(f):
     def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(future)
+        asyncio.run(f(*args, **kwargs))
 
     return wrapper
 
 
+class TestIAP2Stream(unittest.TestCase):
+    def test_write_buffer_limits(self):
+        stream = IAP2Connection(input=None, output=None).control_session
+        self.assertEqual(stream.get_write_buffer_limits(), (16384, 65536))
+        stream.set_write_buffer_limits(high=4000)
+        self.assertEqual(stream.get_write_buffer_limits(), (1000, 4000))
+        stream.set_write_buffer_limits(low=1000)
+        self.assertEqual(stream.get_write_buffer_limits(), (1000, 4000))
+        with self.assertRaises(ValueError):
+            stream.set_write_buffer_limits(high=10, low=20)
+
+    def test_buffered_before_negotiation(self):
+        stream = IAP2Connection(input=None, output=None).create_ea_stream(3)
+        stream.write(b'hello')
+        self.assertEqual(stream.get_write_buffer_size(), 5)
+
+    def test_zero_copy_segmentation(self):
+        conn = IAP2Connection(input=None, output=None)
+        conn.state = STATE_NORMAL
+        packets = []
+        conn.send_packet = packets.append
+        stream = conn.create_ea_stream(3)
+        max_payload = conn.lsp.max_len - 10 - 2
+        data = bytearray(range(256)) * ((2 * max_payload) // 256 + 1)
+        stream.write(data)
+        stream.write(b'tail')
+        self.assertEqual(len(packets), 2)
+        for p in packets:
+            self.assertEqual(p.prefix, b'\x00\x03')
+            self.assertEqual(len(p.data), max_payload)
+        self.assertIs(packets[0].data.obj, data)
+        self.assertEqual(b''.join(p.data for p in packets), data[:2 * max_payload])
+        self.assertEqual(stream.get_write_buffer_size(), len(data) + 4)
+        self.assertEqual(data, bytearray(range(256)) * ((2 * max_payload) // 256 + 1))
+
+    @async_test
+    async def test_read(self):
+        stream = IAP2Connection(input=None, output=None).control_session
+        data = bytearray(b'hello')
+        stream.received_data(data)
+        stream.received_data(b'world')
+        view = await stream.read(2)
+        self.assertIs(view.obj, data)
+        self.assertEqual(view, b'he')
+        self.assertEqual(await stream.read(), b'llo')
+        self.assertEqual(await stream.read(100), b'world')
+        stream.feed_eof()
+        self.assertEqual(await stream.read(), b'')
+
+    @async_test
+    async def test_readinto(self):
+        stream = IAP2Connection(input=None, output=None).control_session
+        stream.received_data(b'abc')
+        stream.received_data(b'defg')
+        buffer = bytearray(5)
+        self.assertEqual(await stream.readinto(buffer), 5)
+        self.assertEqual(buffer, b'abcde')
+        self.assertEqual(await stream.readinto(buffer), 2)
+        self.assertEqual(buffer[:2], b'fg')
+        stream.feed_eof()
+        self.assertEqual(await stream.readinto(buffer), 0)
+
+    @async_test
+    async def test_readexactly_chunks(self):
+        stream = IAP2Connection(input=None, output=None).control_session
+        for chunk in [b'ab', b'cd', b'ef']:
+            stream.received_data(chunk)
+        self.assertEqual(await stream.readexactly(3), b'abc')
+        self.assertEqual(await stream.readexactly(2), b'de')
+        stream.feed_eof()
+        with self.assertRaises(asyncio.exceptions.IncompleteReadError) as cm:
+            await stream.readexactly(2)
+        self.assertEqual(cm.exception.partial, b'f')
+
+    @async_test
+    async def test_readuntil(self):
+        stream = IAP2Connection(input=None, output=None).control_session
+        reader = asyncio.ensure_future(stream.readuntil(b'\r\n'))
+        for chunk in [b'GET', b' /\r', b'\nHost\r\n', b'rest']:
+            stream.received_data(chunk)
+            await asyncio.sleep(0)
+        self.assertEqual(await reader, b'GET /\r\n')
+        self.assertEqual(await stream.readuntil(b'\r\n'), b'Host\r\n')
+        stream.feed_eof()
+        with self.assertRaises(asyncio.exceptions.IncompleteReadError) as cm:
+            await stream.readuntil(b'\r\n')
+        self.assertEqual(cm.exception.partial, b'rest')
+
+    @async_test
+    async def test_async_iteration(self):
+        stream = IAP2Connection(input=None, output=None).control_session
+        chunks = [b'a' * 10, b'b' * 20]
+
+        async def feed():
+            for chunk in chunks:
+                stream.received_data(chunk)
+                await asyncio.sleep(0)
+            stream.feed_eof()
+
+        asyncio.ensure_future(feed())
+        self.assertEqual([bytes(chunk) async for chunk in stream], chunks)
+
+    @async_test
+    async def test_concurrent_readers(self):
+        stream = IAP2Connection(input=None, output=None).control_session
+        first = asyncio.ensure_future(stream.readexactly(4))
+        second = asyncio.ensure_future(stream.readexactly(4))
+        await asyncio.sleep(0)
+        stream.received_data(b'onetw')
+        await asyncio.sleep(0)
+        stream.received_data(b'o!!')
+        self.assertEqual(await first, b'onet')
+        self.assertEqual(await second, b'wo!!')
+
+    @staticmethod
+    async def connected_pair(**kwargs):
+        a, b = memory_transport_pair()
+        conn_a = IAP2Connection(*a, **kwargs)
+        conn_b = IAP2Connection(*b, **kwargs)
+        conn_a.start()
+        conn_b.start()
+        while conn_a.state != STATE_NORMAL or conn_b.state != STATE_NORMAL:
+            await asyncio.sleep(0.01)
+        return conn_a, conn_b
+
+    @async_test
+    async def test_drain_to_low_water(self):
+        conn_a, conn_b = await self.connected_pair(max_outgoing=2, hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        stream = conn_a.create_ea_stream(7)
+        peer = conn_b.create_ea_stream(7)
+        stream.set_write_buffer_limits(high=16384, low=8192)
+        data = bytes(range(256)) * 256
+        stream.write(data)
+        self.assertGreater(stream.get_write_buffer_size(), 16384)
+        self.assertGreater(len(conn_a._queued_packets), 0)
+        await stream.drain()
+        self.assertLessEqual(stream.get_write_buffer_size(), 8192)
+        self.assertEqual(len(stream.out_buffer), 0)
+        self.assertEqual(await peer.readexactly(len(data)), data)
+        await stream.drain()
+        self.assertEqual(stream.get_write_buffer_size(), 0)
+        conn_a.abort()
+
+    @async_test
+    async def test_concurrent_drain(self):
+        conn_a, conn_b = await self.connected_pair(max_outgoing=2, hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        stream = conn_a.control_session
+        stream.set_write_buffer_limits(high=0)
+        stream.write(bytes(20000))
+        first = asyncio.ensure_future(stream.drain())
+        second = asyncio.ensure_future(stream.drain())
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+        self.assertTrue(first.cancelled())
+        self.assertEqual(await conn_b.control_session.readexactly(20000), bytes(20000))
+
+    @async_test
+    async def test_send_file(self):
+        conn_a, conn_b = await self.connected_pair(hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        stream = conn_a.create_ea_stream(4)
+        peer = conn_b.create_ea_stream(4)
+        stream.set_write_buffer_limits(high=16384)
+        data = bytes(range(256)) * 4096
+        positions = []
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            received = asyncio.ensure_future(peer.readexactly(len(data) - 1000))
+            self.assertEqual(await stream.send_file(file, offset=1000, progress=positions.append),
+                             len(data) - 1000)
+            self.assertEqual(await asyncio.wait_for(received, 5), data[1000:])
+            self.assertEqual(file.tell(), len(data))
+            self.assertEqual(positions, sorted(positions))
+            self.assertEqual(positions[-1], len(data))
+
+            self.assertEqual(await stream.send_file(file, offset=10, count=5), 5)
+            self.assertEqual(await peer.readexactly(5), data[10:15])
+            self.assertEqual(await stream.send_file(file, offset=len(data)), 0)
+
+    @async_test
+    async def test_send_file_progress_acknowledged(self):
+        conn_a, conn_b = await self.connected_pair(hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        stream = conn_a.create_ea_stream(4)
+        received = []
+        conn_b.receive_packets(IAP2Connection.EA_SESSION_ID, 4, callback=received.append)
+        stream.set_write_buffer_limits(high=16384)
+        data = bytes(200000)
+
+        def progress(position):
+            # only bytes the peer already got may be reported
+            self.assertLessEqual(position, sum(map(len, received)))
+
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            self.assertEqual(await stream.send_file(file, progress=progress), len(data))
+        self.assertEqual(sum(map(len, received)), len(data))
+        self.assertEqual(len(conn_a._unack_packets), 0)
+        self.assertIsNone(stream._unacked)
+
+    @async_test
+    async def test_send_file_unmaps(self):
+        conn_a, conn_b = await self.connected_pair(hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        stream = conn_a.create_ea_stream(4)
+        peer = conn_b.create_ea_stream(4)
+        mappings = []
+        mmap_type = mmap.mmap
+
+        def recording_mmap(*args, **kwargs):
+            mappings.append(mmap_type(*args, **kwargs))
+            return mappings[-1]
+
+        with tempfile.TemporaryFile() as file, patch("mmap.mmap", recording_mmap):
+            file.write(bytes(50000))
+            self.assertEqual(await stream.send_file(file), 50000)
+        self.assertEqual(len(await peer.readexactly(50000)), 50000)
+        # every packet is acknowledged, nothing references the mapping anymore
+        self.assertTrue(mappings[0].closed)
+
+    @async_test
+    async def test_packet_mode(self):
+        conn_a, conn_b = await self.connected_pair()
+        packets = conn_b.receive_packets(IAP2Connection.CONTROL_SESSION_ID)
+        ea_payloads = []
+        conn_b.receive_packets(IAP2Connection.EA_SESSION_ID, 6, callback=ea_payloads.append)
+        stream = conn_b.create_ea_stream(6)
+        for message in (b'first', b'second'):
+            conn_a.control_session.write(message)
+            await conn_a.control_session.drain()
+        ea = conn_a.create_ea_stream(6)
+        ea.write(b'ea')
+        await ea.drain()
+        self.assertEqual([bytes(await packets.__anext__()) for _ in range(2)], [b'first', b'second'])
+        await asyncio.sleep(0.01)
+        self.assertEqual([bytes(p) for p in ea_payloads], [b'ea'])
+        self.assertEqual(len(stream.in_buffer), 0)
+
+        conn_b.stop_receive_packets(IAP2Connection.CONTROL_SESSION_ID)
+        self.assertEqual([p async for p in packets], [])
+        conn_a.control_session.write(b'stream')
+        await conn_a.control_session.drain()
+        self.assertEqual(await conn_b.control_session.readexactly(6), b'stream')
+
+        packets = conn_b.receive_packets(IAP2Connection.CONTROL_SESSION_ID)
+        conn_b.abort()
+        with self.assertRaises(StopAsyncIteration):
+            await packets.__anext__()
+
+    @async_test
+    async def test_ea_session_packet_mode(self):
+        conn_a, conn_b = await self.connected_pair()
+        packets = conn_b.receive_packets(IAP2Connection.EA_SESSION_ID)
+        stream = conn_b.create_ea_stream(2)
+        for stream_id in (1, 2, 3):
+            ea = conn_a.create_ea_stream(stream_id)
+            ea.write(b'ea %d' % stream_id)
+            await ea.drain()
+        self.assertEqual([bytes(await asyncio.wait_for(packets.__anext__(), 1)) for _ in range(2)],
+                         [b'\x00\x01ea 1', b'\x00\x03ea 3'])
+        self.assertEqual(await stream.readexactly(4), b'ea 2')
+
+    @async_test
+    async def test_receive_budget(self):
+        conn_a, conn_b = await self.connected_pair(max_outgoing=4, hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        stream = conn_a.create_ea_stream(2)
+        peer = conn_b.create_ea_stream(2)
+        peer.set_receive_budget(8192)
+        stream.set_write_buffer_limits(high=0)
+        data = bytes(range(256)) * 256
+        stream.write(data)
+        drain = asyncio.ensure_future(stream.drain())
+        await asyncio.sleep(0.05)
+        self.assertFalse(drain.done())
+        self.assertLess(peer.get_receive_buffer_size(), 8192 + 4096)
+        self.assertTrue(conn_b._receive_held)
+        self.assertEqual(await asyncio.wait_for(peer.readexactly(len(data)), 10), data)
+        await asyncio.wait_for(drain, 1)
+        self.assertFalse(conn_b._receive_held)
+        with self.assertRaises(ValueError):
+            peer.set_receive_budget(0)
+
+    @async_test
+    async def test_receive_budget_slow_reader(self):
+        errors = []
+        conn_a, conn_b = await self.connected_pair(max_outgoing=4, hints=TRANSPORT_LINK_HINTS["usb_hid"],
+                                                   on_error=errors.append)
+        stream = conn_a.create_ea_stream(2)
+        peer = conn_b.create_ea_stream(2)
+        peer.set_receive_budget(2048)
+        stream.write(bytes(200000))
+        # reads keep the stream over budget, the held packets must still be
+        # forced through before the peer gives up on them
+        for _ in range(100):
+            await peer.readexactly(1)
+            await asyncio.sleep(0.02)
+        self.assertEqual(errors, [])
+        self.assertEqual(conn_a.state, STATE_NORMAL)
+        self.assertEqual(conn_b.state, STATE_NORMAL)
+
+    @async_test
+    async def test_connection_receive_budget(self):
+        conn_a, conn_b = await self.connected_pair(max_outgoing=4, hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        conn_b.receive_budget = 4096
+        streams = [conn_a.create_ea_stream(n) for n in range(3)]
+        peers = [conn_b.create_ea_stream(n) for n in range(3)]
+        for stream in streams:
+            stream.write(bytes(6000))
+            await stream.drain()
+        await asyncio.sleep(0.05)
+        buffered = sum(peer.get_receive_buffer_size() for peer in peers)
+        self.assertLess(buffered, 4096 + 4096)
+        for peer in peers:
+            self.assertEqual(await asyncio.wait_for(peer.readexactly(6000), 10), bytes(6000))
+
+    @async_test
+    async def test_receive_budget_packet_queue(self):
+        conn_a, conn_b = await self.connected_pair(max_outgoing=4, hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        conn_b.receive_budget = 4096
+        stream = conn_a.create_ea_stream(1)
+        peer = conn_b.create_ea_stream(1)
+        packets = conn_b.receive_packets(IAP2Connection.EA_SESSION_ID, 1)
+        stream.set_write_buffer_limits(high=0)
+        stream.write(bytes(65536))
+        drain = asyncio.ensure_future(stream.drain())
+        await asyncio.sleep(0.05)
+        self.assertFalse(drain.done())
+        self.assertLess(packets._in_size, 4096 + 4096)
+
+        conn_b.stop_receive_packets(IAP2Connection.EA_SESSION_ID, 1)
+        received = sum([len(p) async for p in packets])
+        self.assertEqual(packets._in_size, 0)
+        await asyncio.wait_for(peer.readexactly(65536 - received), 10)
+        await asyncio.wait_for(drain, 1)
+
+    @async_test
+    async def test_drain_closed(self):
+        conn_a, conn_b = await self.connected_pair(max_outgoing=2, hints=TRANSPORT_LINK_HINTS["usb_hid"])
+        stream = conn_a.control_session
+        stream.set_write_buffer_limits(high=0)
+        stream.write(bytes(100000))
+        drain = asyncio.ensure_future(stream.drain())
+        await asyncio.sleep(0)
+        self.assertFalse(drain.done())
+        conn_a.abort()
+        with self.assertRaises(IOError):
+            await drain
+
+    @async_test
+    async def test_auto_flush(self):
+        conn_a, conn_b = await self.connected_pair()
+        stream = conn_a.create_ea_stream(5)
+        peer = conn_b.create_ea_stream(5)
+        packets = []
+        send_packet = conn_a.send_packet
+        conn_a.send_packet = lambda p: packets.append(p) or send_packet(p)
+        stream.set_auto_flush(delay=0.01)
+        for word in (b'one ', b'two ', b'three'):
+            stream.write(word)
+        self.assertEqual(packets, [])
+        self.assertEqual(await asyncio.wait_for(peer.readexactly(12), 1), b'one two thre')
+        self.assertEqual(len(packets), 1)
+
+        stream.set_auto_flush(delay=10, threshold=8)
+        stream.write(b'1234')
+        self.assertEqual(len(packets), 1)
+        stream.write(b'5678')
+        self.assertEqual(len(packets), 2)
+        self.assertNotIn(stream._flush_key, conn_a._timers)
+        self.assertEqual(await asyncio.wait_for(peer.readexactly(9), 1), b'e12345678')
+
+        stream.set_auto_flush()
+        stream.write(b'stays')
+        await asyncio.sleep(0.02)
+        self.assertEqual(stream.get_write_buffer_size(), 5)
+        with self.assertRaises(ValueError):
+            stream.set_auto_flush(delay=-1)
+
+    @async_test
+    async def test_auto_flush_before_normal(self):
+        a, b = memory_transport_pair()
+        conn_a = IAP2Connection(*a)
+        conn_b = IAP2Connection(*b)
+        stream = conn_a.create_ea_stream(5)
+        peer = conn_b.create_ea_stream(5)
+        auto_flush = stream._auto_flush
+        calls = []
+        stream._auto_flush = lambda: calls.append(None) or auto_flush()
+        stream.set_auto_flush(delay=0)
+        stream.write(b'early')
+        await asyncio.sleep(0.02)
+        # the write waits for the link instead of polling for it
+        self.assertEqual(len(calls), 1)
+        self.assertNotIn(stream._flush_key, conn_a._timers)
+        conn_a.start()
+        conn_b.start()
+        self.assertEqual(await asyncio.wait_for(peer.readexactly(5), 1), b'early')
+        self.assertEqual(conn_a._pending_flushes, set())
+
+
 class SmokeTest(unittest.TestCase):
     @async_test
     async def test(self):
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         input_rx, input_tx = await gen_pipe(loop)
         output_rx, output_tx = await gen_pipe(loop)
         conn = IAP2Connection(
@@ -453,7 +1317,7 @@ class SmokeTest(unittest.TestCase):
     @async_test
     async def test_bailout(self):
         on_error = Mock()
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         input_rx, input_tx = await gen_pipe(loop)
         output_rx, output_tx = await gen_pipe(loop)
         conn = IAP2Connection(
@@ -0,0 +1,47 @@
+import unittest
+
+from iap2.psn_ring import PSNRing
+
+
+class TestPSNRing(unittest.TestCase):
+    def test_put_pop(self):
+        ring = PSNRing()
+        ring.put(10, "a")
+        ring.put(10, "b")
+        self.assertEqual(len(ring), 1)
+        self.assertIn(10, ring)
+        self.assertEqual(ring.get(10), "b")
+        self.assertEqual(ring.pop(10), "b")
+        self.assertIsNone(ring.pop(10))
+        self.assertNotIn(10, ring)
+        self.assertEqual(len(ring), 0)
+
+    def test_sequence_order(self):
+        ring = PSNRing()
+        for psn in [3, 254, 0, 255, 1]:
+            ring.put(psn, psn)
+        self.assertEqual(list(ring.psns(254)), [254, 255, 0, 1, 3])
+        self.assertEqual(list(ring.values(1)), [1, 3, 254, 255, 0])
+
+    def test_pop_while_iterating(self):
+        ring = PSNRing()
+        for psn in range(100, 110):
+            ring.put(psn, psn)
+        for psn in ring.psns(100):
+            ring.pop(psn)
+        self.assertEqual(len(ring), 0)
+
+    def test_missing(self):
+        ring = PSNRing()
+        for psn in [254, 1, 3]:
+            ring.put(psn, psn)
+        self.assertEqual(list(ring.missing(253, 4)), [253, 255, 0, 2])
+        self.assertEqual(list(ring.missing(1, 1)), [])
+
+    def test_last(self):
+        ring = PSNRing()
+        self.assertIsNone(ring.last(0))
+        for psn in [250, 255, 2]:
+            ring.put(psn, psn)
+        self.assertEqual(ring.last(250), 2)
+        self.assertEqual(ring.last(1), 255)
@@ -0,0 +1,38 @@
+import unittest
+
+from iap2.rtt_estimator import RTTEstimator
+
+
+class TestRTTEstimator(unittest.TestCase):
+    def test_initial_rto(self):
+        rtt = RTTEstimator(4000)
+        self.assertIsNone(rtt.srtt)
+        self.assertEqual(rtt.rto, 4000)
+
+    def test_converges(self):
+        rtt = RTTEstimator(4000)
+        rtt.sample(20)
+        self.assertEqual(rtt.srtt, 20)
+        self.assertEqual(rtt.rto, 20 + 4 * 10)
+        for _ in range(100):
+            rtt.sample(5)
+        self.assertAlmostEqual(rtt.srtt, 5, places=3)
+        self.assertEqual(rtt.rto, 10)
+
+    def test_bounds(self):
+        rtt = RTTEstimator(4000)
+        rtt.set_bounds(50, 1000)
+        self.assertEqual(rtt.rto, 1000)
+        rtt.sample(5)
+        self.assertEqual(rtt.rto, 50)
+        rtt.sample(5000)
+        self.assertEqual(rtt.rto, 1000)
+
+    def test_backoff(self):
+        rtt = RTTEstimator(1000)
+        rtt.sample(100)
+        self.assertEqual(rtt.rto, 300)
+        rtt.backoff()
+        self.assertEqual(rtt.rto, 600)
+        rtt.backoff()
+        self.assertEqual(rtt.rto, 1000)
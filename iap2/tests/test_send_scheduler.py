@@ -0,0 +1,68 @@
+import unittest
+
+from iap2.link_layer import IAP2Packet, IAP2Connection
+from iap2.send_scheduler import SendScheduler
+
+
+def ea(stream_id, n):
+    return IAP2Packet(bytes([0, stream_id, n]), session_id=11)
+
+
+class TestSendScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = SendScheduler(priority_sessions=[10], stream_sessions=[11])
+
+    def drain(self):
+        packets = []
+        while len(self.scheduler):
+            packets.append(self.scheduler.popleft())
+        return packets
+
+    def test_priority_first(self):
+        packets = [ea(1, 0), ea(1, 1)]
+        for p in packets:
+            self.scheduler.append(p)
+        control = IAP2Packet(b'auth', session_id=10)
+        self.scheduler.append(control)
+        self.assertEqual(len(self.scheduler), 3)
+        self.assertEqual(self.drain(), [control] + packets)
+
+    def test_round_robin(self):
+        for n in range(3):
+            self.scheduler.append(ea(1, n))
+        for n in range(2):
+            self.scheduler.append(ea(2, n))
+        self.assertEqual([(p.data[1], p.data[2]) for p in self.drain()],
+                         [(1, 0), (2, 0), (1, 1), (2, 1), (1, 2)])
+
+    def test_weights(self):
+        self.scheduler.set_weight(11, 1, 3)
+        for n in range(4):
+            self.scheduler.append(ea(1, n))
+            self.scheduler.append(ea(2, n))
+        self.assertEqual([p.data[1] for p in self.drain()], [1, 1, 1, 2, 1, 2, 2, 2])
+        with self.assertRaises(ValueError):
+            self.scheduler.set_weight(11, 1, 0)
+
+    def test_remove_weight(self):
+        self.scheduler.set_weight(11, 1, 3)
+        self.scheduler.remove_weight(11, 1)
+        self.scheduler.remove_weight(11, 2)
+        for n in range(2):
+            self.scheduler.append(ea(1, n))
+            self.scheduler.append(ea(2, n))
+        self.assertEqual([p.data[1] for p in self.drain()], [1, 2, 1, 2])
+
+    def test_closed_stream_drops_weight(self):
+        conn = IAP2Connection(input=None, output=None)
+        conn.create_ea_stream(1, weight=3)
+        conn.close_ea_stream(1)
+        self.assertEqual(conn._queued_packets._weights, {})
+
+    def test_fifo_within_flow(self):
+        packets = [IAP2Packet(bytes([n]), session_id=12) for n in range(3)]
+        for p in packets:
+            self.scheduler.append(p)
+        self.assertEqual(self.drain(), packets)
+        with self.assertRaises(IndexError):
+            self.scheduler.popleft()
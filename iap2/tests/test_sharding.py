@@ -0,0 +1,99 @@
+import asyncio
+import socket
+import unittest
+from unittest.mock import Mock
+
+from iap2.link_layer import IAP2Connection, STATE_NORMAL
+from iap2.sharding import ShardSupervisor
+from iap2.tests.test_connection_manager import wait_for
+
+
+async def echo(conn):
+    while True:
+        data = await conn.control_session.readexactly(4)
+        conn.control_session.write(data)
+        await conn.control_session.drain()
+
+
+class TestShardSupervisor(unittest.TestCase):
+    def test_dispatch(self):
+        async def run():
+            supervisor = ShardSupervisor(workers=2, on_connection=echo)
+            supervisor.start()
+            try:
+                await supervisor.serve()
+                connections = []
+                for _ in range(4):
+                    reader, writer = await asyncio.open_connection(*supervisor.address)
+                    conn = IAP2Connection(writer, reader)
+                    conn.start()
+                    connections.append(conn)
+                await wait_for(lambda: all(conn.state == STATE_NORMAL for conn in connections), timeout=30)
+
+                for i, conn in enumerate(connections):
+                    conn.control_session.write(b'pin%d' % i)
+                    await conn.control_session.drain()
+                for i, conn in enumerate(connections):
+                    self.assertEqual(await conn.control_session.readexactly(4), b'pin%d' % i)
+
+                stats = await supervisor.stats()
+                self.assertEqual(stats.connections, 4)
+                self.assertEqual(stats.established, 4)
+                self.assertEqual(stats.errors, 0)
+
+                for conn in connections:
+                    conn.abort()
+            finally:
+                await supervisor.close()
+
+        asyncio.run(run())
+
+    def fake_workers(self, supervisor, count):
+        """Adds workers without processes, returns the sockets of their end."""
+        ends = []
+        for _ in range(count):
+            parent_sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            parent_sock.setblocking(False)
+            supervisor._workers.append((Mock(pid=0), parent_sock))
+            ends.append(worker_sock)
+        return ends
+
+    def test_dispatch_skips_unavailable_workers(self):
+        supervisor = ShardSupervisor(workers=2)
+        full, idle = self.fake_workers(supervisor, 2)
+        try:
+            while True:
+                supervisor._workers[0][1].send(b'x')
+        except BlockingIOError:
+            pass
+        a, b = socket.socketpair()
+        supervisor.dispatch(a)
+        self.assertEqual(a.fileno(), -1)
+        command, fds, _flags, _address = socket.recv_fds(idle, 1, 1)
+        self.assertEqual((command, len(fds)), (b'C', 1))
+        socket.socket(fileno=fds[0]).close()
+
+        full.close()
+        idle.close()
+        c, d = socket.socketpair()
+        with self.assertRaises(ConnectionError):
+            supervisor.dispatch(c)
+        self.assertEqual(c.fileno(), -1)
+        for sock in (b, d):
+            sock.close()
+        for _process, sock in supervisor._workers:
+            sock.close()
+
+    def test_stats_of_exited_worker(self):
+        async def run():
+            supervisor = ShardSupervisor(workers=1)
+            (end,) = self.fake_workers(supervisor, 1)
+            end.setblocking(False)
+            stats = asyncio.ensure_future(supervisor.stats())
+            await asyncio.get_running_loop().sock_recv(end, 1)
+            end.close()
+            with self.assertRaises(ConnectionError):
+                await stats
+            supervisor._workers[0][1].close()
+
+        asyncio.run(run())
@@ -1 +1 @@
-__all__ = ["bluetooth", "usb_host", "usb_device"]
+__all__ = ["bluetooth", "usb_host", "usb_device", "memory"]
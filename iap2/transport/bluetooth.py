@@ -12,6 +12,7 @@ from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib
 
 import iap2.carplay_bonjour as carplay_bonjour
+from iap2.link_layer import TRANSPORT_LINK_HINTS
 
 BUS_NAME = 'org.bluez'
 PROFILE_INTERFACE = 'org.bluez.Profile1'
@@ -173,6 +174,8 @@ IAP_RECORD = f"""
 
 
 class BluetoothTransport:
+    link_hints = TRANSPORT_LINK_HINTS["bluetooth"]
+
     def __init__(self, on_connection, loop):
 
         self._glib_loop = GLib.MainLoop()
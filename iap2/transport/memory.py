@@ -0,0 +1,35 @@
+__all__ = ["MemoryWriter", "memory_transport_pair"]
+
+import asyncio
+
+
+class MemoryWriter:
+    """Writer which feeds everything written straight into a StreamReader."""
+
+    def __init__(self, reader: asyncio.StreamReader):
+        self._reader = reader
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise IOError("closed")
+        self._reader.feed_data(data)
+
+    def writelines(self, buffers):
+        self.write(b''.join(buffers))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._reader.feed_eof()
+
+
+def memory_transport_pair():
+    """Returns two ``(output, input)`` pairs connected back to back.
+
+    Has to be called with the loop running the connections as running loop.
+    """
+    a_input = asyncio.StreamReader()
+    b_input = asyncio.StreamReader()
+    return (MemoryWriter(b_input), a_input), (MemoryWriter(a_input), b_input)
@@ -4,13 +4,16 @@ import queue
 import hid
 import asyncio
 
+from iap2.link_layer import TRANSPORT_LINK_HINTS
+
 
 class BaseUSBDeviceHandler:
-    def __init__(self):
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
         context = usb1.USBContext()
         context.open()
 
-        loop = asyncio.get_event_loop()
+        if loop is None:
+            loop = asyncio.get_running_loop()
 
         def added_cb(fd, events):
             if events & 1:
@@ -43,8 +46,8 @@ class BaseUSBDeviceHandler:
 
 
 class USBRoleSwitchHandler(BaseUSBDeviceHandler):
-    def __init__(self, after_role_switch, car_play=False):
-        super().__init__()
+    def __init__(self, after_role_switch, car_play=False, loop: asyncio.AbstractEventLoop = None):
+        super().__init__(loop)
         self._after_role_switch = after_role_switch
         self._car_play = car_play
 
@@ -58,8 +61,8 @@ class USBRoleSwitchHandler(BaseUSBDeviceHandler):
 
 
 class USBDeviceTransport(BaseUSBDeviceHandler):
-    def __init__(self, on_connection):
-        super().__init__()
+    def __init__(self, on_connection, loop: asyncio.AbstractEventLoop = None):
+        super().__init__(loop)
         self._on_connection = on_connection
 
     async def _handle_new_device(self, device):
@@ -115,7 +118,7 @@ class USBDeviceTransport(BaseUSBDeviceHandler):
 
 def _usb_control_transfer(device, request_type, request, value, index, length):
     transfer = device.getTransfer()
-    future = asyncio.get_event_loop().create_future()
+    future = asyncio.get_running_loop().create_future()
 
     def cb(transfer):
         status = transfer.getStatus()
@@ -151,15 +154,24 @@ def get_descriptor_items(descriptor):
 LCB_CONTINUATION = 1
 LCB_MORE_TO_FOLLOW = 2
 
+# upper bound of HID reports a single link packet gets split into
+HID_REPORTS_PER_FRAME = 32
+
+
+def hid_link_hints(report_payload_len):
+    hints = TRANSPORT_LINK_HINTS["usb_hid"]
+    return hints._replace(max_len=min(hints.max_len, report_payload_len * HID_REPORTS_PER_FRAME))
+
 
 class HIDReader:
     def __init__(self, hid_device, input_report_ids):
-        self._loop = asyncio.get_event_loop()
+        self._loop = asyncio.get_running_loop()
         self._hid_device = hid_device
         self._input_report_ids = input_report_ids
         self._read_buffer_semaphore = threading.Semaphore(value=3)
         self._read_buffer_queue = asyncio.Queue()
         self._max_len = max(input_report_ids.values())
+        self.link_hints = hid_link_hints(self._max_len - 1)
         self.eof = False
         self._read_buffer = None
         threading.Thread(target=self._read_loop).start()
@@ -185,6 +197,19 @@ class HIDReader:
             self._read_buffer = b[nbytes:]
             return b[:nbytes]
 
+    async def read(self, n=-1):
+        if not self._read_buffer or len(self._read_buffer) == 0:
+            self._read_buffer_semaphore.release()
+            if self.eof:
+                return b''
+            self._read_buffer = await self._read_buffer_queue.get()
+
+        if n < 0:
+            n = len(self._read_buffer)
+        b = self._read_buffer[:n]
+        self._read_buffer = self._read_buffer[n:]
+        return b
+
     def reset(self):
         self._read_buffer = None
 
@@ -226,6 +251,7 @@ class HIDWriter:
         self.closed = False
         self._hid_device = hid_device
         self._output_report_ids = output_report_ids
+        self.link_hints = hid_link_hints(max(count for _id, count in output_report_ids) - 1)
         self._write_buffer_queue = queue.Queue()
         threading.Thread(target=self._write_loop).start()
 
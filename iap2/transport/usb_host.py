@@ -30,12 +30,16 @@ from functionfs.gadget import (
 import functionfs.ch9
 import asyncio
 
+from iap2.link_layer import TRANSPORT_LINK_HINTS
+
 # Large-ish buffer, to tolerate bursts without becoming a context switch storm.
 BUF_SIZE = 1024 * 1024
 
 trace = functools.partial(print, file=sys.stderr)
 
 class EndpointOUTFile(functionfs.EndpointOUTFile, asyncio.StreamReader):
+    link_hints = TRANSPORT_LINK_HINTS["usb_bulk"]
+
     def __init__(self, *args, **kw):
         functionfs.EndpointOUTFile.__init__(self, *args, **kw)
         asyncio.StreamReader.__init__(self)
@@ -48,6 +52,8 @@ class EndpointOUTFile(functionfs.EndpointOUTFile, asyncio.StreamReader):
             self.feed_data(data)
 
 class EndpointINFile(functionfs.EndpointINFile):
+    link_hints = TRANSPORT_LINK_HINTS["usb_bulk"]
+
     def __init__(self, *args, **kw):
         self.__stranded_buffer_list_queue = deque()
         self._full = False
@@ -155,11 +161,9 @@ class SubprocessCat(ConfigFunctionFFS):
 
 
 
-
-loop = asyncio.get_event_loop()
-
-
 def main():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     s = SubprocessCat()
     s.start(path="/sys/kernel/config/usb_gadget/isticktoit/ffs.sda")
     s.function = function = s.getFunction()